@@ -0,0 +1,371 @@
+"""Benchmark scenarios of the BIG-IQ driver.
+
+Runs BIGIQDriver against a stub LBaaSv2 plugin on an in-memory SQLite DB,
+casting to the agents over the oslo.messaging fake transport, and prints
+the throughput, p50/p99 latency and DB statements of every scenario:
+
+- member_creates: members created one API call at a time on one pool,
+- cascade_deletes: loadbalancers of 100 members destroyed with their
+  children in one resources_destroyed callback,
+- status_storm: one update_member_status callback per member,
+- status_batch: the same statuses through update_statuses,
+- stats_storm: one update_loadbalancer_stats callback per loadbalancer,
+- status_concurrent: update_member_status callbacks from --threads threads
+  while half of the members are marked PENDING_DELETE, checking that none
+  of those loses its PENDING_DELETE status.
+
+    python benchmarks/driver_scenarios.py --scenario member_creates \\
+        --count 10000
+
+With --allocations, the memory allocated by each scenario is traced too,
+which slows it down: compare timings of runs without it. Tracing needs
+Python 3. The in-memory SQLite DB shares one connection between threads:
+run status_concurrent with --connection set to a SQLite file or a MySQL
+URL.
+"""
+import argparse
+import collections
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.7
+    tracemalloc = None
+
+from neutron.common import rpc as n_rpc
+from neutron.db.migration.models import head  # noqa
+from neutron.db.models import agent as agents_db
+from neutron_lib import constants as n_const
+from neutron_lib import context as neutron_context
+from neutron_lib.db import api as db_api
+from neutron_lib.db import model_base
+from oslo_config import cfg
+from oslo_db import options as db_options
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+from oslo_utils import uuidutils
+from sqlalchemy import event
+
+from neutron_lbaas import agent_scheduler as lbaas_agent_scheduler
+from neutron_lbaas.db.loadbalancer import loadbalancer_dbv2
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import constants as lb_const
+from neutron_lbaas.services.loadbalancer import data_models
+
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api as f5_db_api
+from f5_lbaasv2_bigiq_driver import driver_bigiq
+from f5_lbaasv2_bigiq_driver import reconciler
+
+PROJECT_ID = 'bench-project'
+AGENT_HOST = 'bench-agent'
+MEMBERS_PER_LOADBALANCER = 100
+
+
+class FakePluginDb(loadbalancer_dbv2.LoadBalancerPluginDbv2,
+                   lbaas_agent_scheduler.LbaasAgentSchedulerDbMixin):
+    """The LBaaSv2 plugin DB mixins, without a core plugin."""
+
+
+class FakePlugin(object):
+    """The parts of the LBaaSv2 plugin used by the driver."""
+
+    def __init__(self):
+        self.db = FakePluginDb()
+        self.agent_notifiers = {}
+        self.workers = []
+
+    def add_worker(self, worker):
+        self.workers.append(worker)
+
+
+class QueryCounter(object):
+    """Count the SQL statements run on an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def add_agent(context):
+    agent = agents_db.Agent(
+        id=uuidutils.generate_uuid(),
+        agent_type=constants.LBAASV2_BIGIQ_AGENT_TYPE,
+        binary='f5-oslbaasv2-bigiq-agent',
+        topic=constants.TOPIC_LBAASV2_BIGIQ_AGENT,
+        host=AGENT_HOST,
+        admin_state_up=True,
+        created_at=timeutils.utcnow(),
+        started_at=timeutils.utcnow(),
+        heartbeat_timestamp=timeutils.utcnow(),
+        configurations=jsonutils.dumps(
+            {'rpc_api_version': constants.RPC_API_VERSION_TRACING}))
+    with context.session.begin(subtransactions=True):
+        context.session.add(agent)
+    return agent
+
+
+def add_loadbalancer(context, agent, members, member_status):
+    """Add a loadbalancer with a listener, a pool and members to the DB."""
+    status = {'provisioning_status': n_const.ACTIVE,
+              'operating_status': lb_const.ONLINE,
+              'admin_state_up': True}
+    lb_id = uuidutils.generate_uuid()
+    pool_id = uuidutils.generate_uuid()
+    with context.session.begin(subtransactions=True):
+        context.session.add(models.LoadBalancer(
+            id=lb_id, project_id=PROJECT_ID, name='bench',
+            vip_subnet_id=uuidutils.generate_uuid(),
+            vip_address='10.0.0.10', **status))
+        context.session.add(models.PoolV2(
+            id=pool_id, project_id=PROJECT_ID, loadbalancer_id=lb_id,
+            protocol='HTTP', lb_algorithm='ROUND_ROBIN', **status))
+        context.session.add(models.Listener(
+            id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+            loadbalancer_id=lb_id, default_pool_id=pool_id, protocol='HTTP',
+            protocol_port=80, connection_limit=-1, **status))
+        for index in range(members):
+            context.session.add(models.MemberV2(
+                id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                pool_id=pool_id, address='10.1.%d.%d' % divmod(index, 250),
+                protocol_port=8080, weight=1, admin_state_up=True,
+                provisioning_status=member_status,
+                operating_status=lb_const.OFFLINE))
+        # The binding has no relationship ordering it after the rows
+        context.session.flush()
+        binding = lbaas_agent_scheduler.LoadbalancerAgentBinding()
+        binding.agent_id = agent.id
+        binding.loadbalancer_id = lb_id
+        context.session.add(binding)
+    return lb_id
+
+
+def get_loadbalancer(context, lb_id):
+    lb_db = context.session.query(models.LoadBalancer).get(lb_id)
+    return data_models.LoadBalancer.from_sqlalchemy_model(lb_db)
+
+
+def flush(driver):
+    driver.member_batcher.flush_all()
+    driver.agent_rpc.stop()
+
+
+def member_creates(driver, agent, count):
+    context = neutron_context.get_admin_context()
+    lb_id = add_loadbalancer(context, agent, count, n_const.PENDING_CREATE)
+    members = get_loadbalancer(context, lb_id).pools[0].members
+
+    def run(latencies):
+        for member in members:
+            start = time.time()
+            driver.member.create(neutron_context.get_admin_context(), member)
+            latencies.append(time.time() - start)
+        flush(driver)
+    return run
+
+
+def cascade_deletes(driver, agent, count):
+    context = neutron_context.get_admin_context()
+    lb_ids = [add_loadbalancer(context, agent, MEMBERS_PER_LOADBALANCER,
+                               n_const.ACTIVE)
+              for _ in range(max(count // MEMBERS_PER_LOADBALANCER, 1))]
+    trees = []
+    for lb_id in lb_ids:
+        resources = collections.defaultdict(list)
+        for entity_type, entity_id in reconciler.walk_loadbalancer(
+                get_loadbalancer(context, lb_id)):
+            resources[entity_type].append(entity_id)
+        trees.append(dict(resources))
+
+    def run(latencies):
+        for resources in trees:
+            start = time.time()
+            driver.plugin_rpc.resources_destroyed(
+                neutron_context.get_admin_context(), resources=resources)
+            latencies.append(time.time() - start)
+    return run
+
+
+def _pending_member_ids(context, agent, count):
+    lb_id = add_loadbalancer(context, agent, count, n_const.PENDING_CREATE)
+    return [member.id
+            for member in get_loadbalancer(context, lb_id).pools[0].members]
+
+
+def status_storm(driver, agent, count):
+    member_ids = _pending_member_ids(
+        neutron_context.get_admin_context(), agent, count)
+
+    def run(latencies):
+        for member_id in member_ids:
+            start = time.time()
+            driver.plugin_rpc.update_member_status(
+                neutron_context.get_admin_context(), member_id=member_id,
+                provisioning_status=n_const.ACTIVE,
+                operating_status=lb_const.ONLINE)
+            latencies.append(time.time() - start)
+    return run
+
+
+def status_batch(driver, agent, count, batch_size=500):
+    member_ids = _pending_member_ids(
+        neutron_context.get_admin_context(), agent, count)
+
+    def run(latencies):
+        for index in range(0, len(member_ids), batch_size):
+            statuses = [('member', member_id, n_const.ACTIVE, lb_const.ONLINE)
+                        for member_id in member_ids[index:index + batch_size]]
+            start = time.time()
+            driver.plugin_rpc.update_statuses(
+                neutron_context.get_admin_context(), statuses=statuses)
+            latencies.append(time.time() - start)
+    return run
+
+
+def stats_storm(driver, agent, count):
+    context = neutron_context.get_admin_context()
+    lb_ids = [add_loadbalancer(context, agent, 0, n_const.ACTIVE)
+              for _ in range(count)]
+    stats = {'bytes_in': 1024, 'bytes_out': 4096, 'active_connections': 8,
+             'total_connections': 64}
+
+    def run(latencies):
+        for lb_id in lb_ids:
+            start = time.time()
+            driver.plugin_rpc.update_loadbalancer_stats(
+                neutron_context.get_admin_context(), loadbalancer_id=lb_id,
+                stats=stats)
+            latencies.append(time.time() - start)
+        driver.stats_writer.flush()
+    return run
+
+
+def status_concurrent(driver, agent, count, threads=8):
+    member_ids = _pending_member_ids(
+        neutron_context.get_admin_context(), agent, count)
+    deleted_ids = member_ids[::2]
+
+    def update(ids, latencies):
+        for member_id in ids:
+            start = time.time()
+            driver.plugin_rpc.update_member_status(
+                neutron_context.get_admin_context(), member_id=member_id,
+                provisioning_status=n_const.ACTIVE,
+                operating_status=lb_const.ONLINE)
+            latencies.append(time.time() - start)
+
+    def mark_deleted():
+        for member_id in deleted_ids:
+            context = neutron_context.get_admin_context()
+            with context.session.begin(subtransactions=True):
+                f5_db_api.update_statuses(
+                    context.session, 'member', [member_id],
+                    provisioning_status=n_const.PENDING_DELETE)
+
+    def run(latencies):
+        workers = [threading.Thread(target=update,
+                                    args=(member_ids[index::threads],
+                                          latencies))
+                   for index in range(threads)]
+        workers.append(threading.Thread(target=mark_deleted))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        context = neutron_context.get_admin_context()
+        lost = 0
+        for chunk in f5_db_api.chunks(deleted_ids):
+            lost += context.session.query(models.MemberV2).filter(
+                models.MemberV2.id.in_(chunk),
+                models.MemberV2.provisioning_status !=
+                n_const.PENDING_DELETE).count()
+        if lost:
+            print('status_concurrent: %d members lost PENDING_DELETE' % lost)
+    return run
+
+
+SCENARIOS = [
+    ('member_creates', member_creates),
+    ('cascade_deletes', cascade_deletes),
+    ('status_storm', status_storm),
+    ('status_batch', status_batch),
+    ('stats_storm', stats_storm),
+    ('status_concurrent', status_concurrent),
+]
+
+
+def setup(connection):
+    cfg.CONF([], project='neutron')
+    cfg.CONF.set_override('transport_url', 'fake:/')
+    db_options.set_defaults(cfg.CONF, connection=connection)
+    n_rpc.init(cfg.CONF)
+    engine = db_api.get_context_manager().writer.get_engine()
+    model_base.BASEV2.metadata.create_all(engine)
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', default='all',
+                        choices=['all'] + [name for name, _ in SCENARIOS])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--allocations', action='store_true',
+                        help='Trace the peak memory of each scenario')
+    parser.add_argument('--connection', default='sqlite://',
+                        help='DB URL, an empty in-memory SQLite DB by default')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads of the status_concurrent scenario')
+    args = parser.parse_args()
+    if args.allocations and tracemalloc is None:
+        parser.error('--allocations needs tracemalloc, from Python 3.4')
+
+    engine = setup(args.connection)
+    queries = QueryCounter(engine)
+    driver = driver_bigiq.BIGIQDriver(FakePlugin())
+    agent = add_agent(neutron_context.get_admin_context())
+
+    print('%-16s %8s %10s %10s %10s %9s %10s' % (
+        'scenario', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 'queries',
+        'peak KiB'))
+    for name, scenario in SCENARIOS:
+        if args.scenario not in ('all', name):
+            continue
+        options = {}
+        if name == 'status_concurrent':
+            if args.connection == 'sqlite://':
+                print('%-16s skipped, needs --connection' % name)
+                continue
+            options['threads'] = args.threads
+        run = scenario(driver, agent, args.count, **options)
+        latencies = []
+        queries.count = 0
+        if args.allocations:
+            tracemalloc.start()
+        start = time.time()
+        run(latencies)
+        elapsed = time.time() - start
+        peak = 0
+        if args.allocations:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print('%-16s %8d %10.0f %10.3f %10.3f %9d %10.0f' % (
+            name, len(latencies), len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, queries.count, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Micro-benchmark of the prepared client cache of BIGIQAgentRPC.
+
+Sends create_member casts over the oslo.messaging fake transport, with a
+client prepared for every message and with the cached prepared clients,
+and prints the messages per second of both.
+
+    python benchmarks/rpc_client_cache.py --messages 20000 --hosts 4
+"""
+import argparse
+import time
+
+from neutron.common import rpc as n_rpc
+from neutron_lib import context as neutron_context
+from oslo_config import cfg
+
+from f5_lbaasv2_bigiq_driver import agent_rpc
+
+LOADBALANCER = {'id': 'lb-1', 'name': 'lb', 'vip_address': '10.0.0.10',
+                'provisioning_status': 'ACTIVE', 'listeners': [],
+                'pools': []}
+MEMBER = {'id': 'member-1', 'pool_id': 'pool-1', 'address': '10.0.1.10',
+          'protocol_port': 80, 'weight': 1, 'admin_state_up': True}
+
+
+class UncachedBIGIQAgentRPC(agent_rpc.BIGIQAgentRPC):
+    """BIGIQAgentRPC preparing a new client for every message."""
+
+    def _get_callee(self, options):
+        if options:
+            return self._client.prepare(**options)
+        return self._client
+
+
+def run(rpc_api, context, messages, hosts):
+    start = time.time()
+    for index in range(messages):
+        rpc_api.create_member(context, 'host-%d' % (index % hosts), MEMBER,
+                              loadbalancer=LOADBALANCER)
+    return messages / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    cfg.CONF([], project='neutron')
+    cfg.CONF.set_override('transport_url', 'fake:/')
+    n_rpc.init(cfg.CONF)
+    context = neutron_context.get_admin_context()
+
+    for name, rpc_class in (('uncached', UncachedBIGIQAgentRPC),
+                            ('cached', agent_rpc.BIGIQAgentRPC)):
+        rpc_api = rpc_class()
+        # Warm up, and fill the cache of the cached client
+        run(rpc_api, context, args.hosts, args.hosts)
+        rates = [run(rpc_api, context, args.messages, args.hosts)
+                 for _ in range(args.rounds)]
+        print('%-8s best %10.0f msg/s  mean %10.0f msg/s' % (
+            name, max(rates), sum(rates) / len(rates)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import collections
+import datetime
+
+from neutron.db.models import agent as agents_db
+from neutron_lib import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_service import loopingcall
+from oslo_utils import timeutils
+
+from neutron_lbaas import agent_scheduler as lbaas_agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import data_models
+
+from f5_lbaasv2_bigiq_driver import agent_scheduler
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_agent_monitor_interval',
+        default=60,
+        help=('Seconds between checks of the BIG-IQ agent heartbeats. 0 '
+              'disables the failover of the loadbalancers of dead agents.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_agent_failover_grace',
+        default=300,
+        help=('Seconds a BIG-IQ agent must stay dead, beyond '
+              'agent_down_time, before its loadbalancers are moved to '
+              'healthy agents.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_agent_failover_batch_size',
+        default=100,
+        help=('Number of loadbalancers of a dead BIG-IQ agent moved in '
+              'each transaction.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class AgentMonitor(object):
+    """Move the loadbalancers of dead BIG-IQ agents to healthy ones.
+
+    Agents report their state through AgentExtRpcCallback, which records
+    their heartbeats. An agent whose last heartbeat is older than
+    agent_down_time plus the failover grace has its loadbalancers
+    rescheduled by the driver scheduler, and the agents taking them over
+    are asked to resynchronize their services.
+
+    Every API worker runs a monitor. Bindings are moved only if they are
+    still on the dead agent, so each loadbalancer is moved once.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.interval = cfg.CONF.f5_bigiq_agent_monitor_interval
+        self.grace = cfg.CONF.f5_bigiq_agent_failover_grace
+        self.batch_size = max(cfg.CONF.f5_bigiq_agent_failover_batch_size, 1)
+        self._loop = None
+
+    def start(self):
+        if self.interval > 0 and self._loop is None:
+            self._loop = loopingcall.FixedIntervalLoopingCall(self.check)
+            self._loop.start(interval=self.interval,
+                             initial_delay=self.interval)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+    def get_failed_agents(self, context):
+        """Return the agents dead for longer than the failover grace."""
+        cutoff = timeutils.utcnow() - datetime.timedelta(
+            seconds=cfg.CONF.agent_down_time + self.grace)
+        query = context.session.query(agents_db.Agent)
+        query = query.filter(
+            agents_db.Agent.agent_type == constants.LBAASV2_BIGIQ_AGENT_TYPE,
+            agents_db.Agent.heartbeat_timestamp < cutoff)
+        # Agents of other groups fail over within their own group
+        group = cfg.CONF.f5_bigiq_agent_group
+        return [agent for agent in query if group is None or
+                agent_scheduler.get_agent_group(agent) == group]
+
+    def check(self):
+        context = neutron_context.get_admin_context()
+        try:
+            for agent in self.get_failed_agents(context):
+                self.failover(context, agent)
+        except Exception as e:
+            LOG.error('Failed to check BIG-IQ agent health: %s', e)
+
+    def failover(self, context, agent):
+        """Move the loadbalancers of a dead agent to healthy agents.
+
+        Returns the number of loadbalancers moved by this worker.
+        """
+        # Loadbalancers stay in the group of their agent, even when this
+        # server schedules to all groups
+        scheduler = self.driver.scheduler
+        candidates = [candidate for candidate in
+                      scheduler.get_group_candidates(
+                          context, agent_scheduler.get_agent_group(agent))
+                      if candidate.id != agent.id]
+        if not candidates:
+            LOG.warning('No healthy BIG-IQ agent to take over the '
+                        'loadbalancers of dead agent %s', agent.host)
+            return 0
+
+        builder = self.driver.service_builder
+        moved_to = collections.defaultdict(set)
+        marker = None
+        while True:
+            loadbalancer_ids = builder.get_loadbalancer_ids(
+                context, agent.host, marker=marker, limit=self.batch_size)
+            if not loadbalancer_ids:
+                break
+            for host, moved in self._rebind(
+                    context, agent, candidates, loadbalancer_ids).items():
+                moved_to[host].update(moved)
+            if len(loadbalancer_ids) < self.batch_size:
+                break
+            marker = loadbalancer_ids[-1]
+
+        # Cached bindings may still point to the dead agent
+        self.driver.binding_cache.pop_if(
+            lambda loadbalancer_id, cached: cached['host'] == agent.host)
+
+        total = sum(len(moved) for moved in moved_to.values())
+        if total:
+            LOG.warning('Moved %d loadbalancers of dead BIG-IQ agent %s to '
+                        'agents %s', total, agent.host,
+                        ', '.join(sorted(moved_to)))
+        candidates = dict((candidate.host, candidate)
+                          for candidate in candidates)
+        for host in moved_to:
+            self._resync(context, candidates[host])
+        return total
+
+    def _rebind(self, context, agent, candidates, loadbalancer_ids):
+        # Returns a dict of agent host to the ids of the loadbalancers this
+        # worker moved to it.
+        query = context.session.query(models.LoadBalancer.id,
+                                      models.LoadBalancer.project_id)
+        query = query.filter(models.LoadBalancer.id.in_(loadbalancer_ids))
+        loadbalancers = [data_models.LoadBalancer(id=row.id,
+                                                  tenant_id=row.project_id)
+                         for row in query]
+
+        binding = lbaas_agent_scheduler.LoadbalancerAgentBinding
+        moved_to = {}
+        with context.session.begin(subtransactions=True):
+            targets = collections.defaultdict(list)
+            selected = self.driver.scheduler.select_many(
+                context, loadbalancers, candidates)
+            for loadbalancer_id, target in selected.items():
+                targets[target.id].append(loadbalancer_id)
+            hosts = dict((candidate.id, candidate.host)
+                         for candidate in candidates)
+            for target_id, ids in targets.items():
+                if not db_api.rebind_loadbalancers(
+                        context.session, ids, agent.id, target_id):
+                    continue
+                moved = set()
+                for chunk in db_api.chunks(ids):
+                    query = context.session.query(binding.loadbalancer_id)
+                    query = query.filter(binding.loadbalancer_id.in_(chunk),
+                                         binding.agent_id == target_id)
+                    moved.update(row.loadbalancer_id for row in query)
+                moved_to[hosts[target_id]] = moved
+        return moved_to
+
+    def _resync(self, context, agent):
+        self.driver.agent_rpc.register_agent(agent)
+        if not self.driver.agent_rpc.supports(
+                agent, constants.RPC_API_VERSION_SYNC_SERVICES):
+            LOG.warning('Agent %s cannot resynchronize the loadbalancers it '
+                        'took over, it must be restarted to deploy them',
+                        agent.host)
+            return
+        self.driver.plugin_rpc.sync_services(context, host=agent.host)
@@ -1,13 +1,85 @@
-from oslo_log import helpers as log_helpers
+import threading
+import time
+
+from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging as messaging
+from oslo_serialization import jsonutils
+from six.moves import reprlib
 
 from neutron.common import rpc
-
+from neutron_lib import constants as q_const
+from neutron_lib import context as neutron_context
+from neutron_lib.callbacks import events
+from neutron_lib.callbacks import registry
+from neutron_lib.callbacks import resources
+
+from f5_lbaasv2_bigiq_driver import agent_scheduler
+from f5_lbaasv2_bigiq_driver import cast_pool
+from f5_lbaasv2_bigiq_driver import compression
 from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import metrics
+from f5_lbaasv2_bigiq_driver import tracing
 
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_rpc_log_max_length',
+        default=2048,
+        help=('Maximum length of the arguments of a cast to a BIG-IQ agent '
+              'in debug logs. Longer arguments are abbreviated.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+ENTITY_TYPES = ('loadbalancer', 'listener', 'pool', 'member',
+                'health_monitor', 'l7policy', 'l7rule')
+
+# Casts to the BIG-IQ agent: method name -> (names of the arguments
+# following context and host, minimum RPC API version or None).
+OPERATIONS = {
+    'update_loadbalancer_stats': (('loadbalancer',), None),
+    'batch_members': (('loadbalancer', 'members'),
+                      constants.RPC_API_VERSION_BATCH_MEMBERS),
+    'update_delta': (('entity_type', 'entity_id', 'loadbalancer_id',
+                      'changes'),
+                     constants.RPC_API_VERSION_DELTA_UPDATE),
+    'sync_services': (('services',),
+                      constants.RPC_API_VERSION_SYNC_SERVICES),
+}
+# Casts which may carry many entities, and so may be worth compressing
+COMPRESSIBLE = frozenset(['batch_members', 'sync_services'])
+for _entity_type in ENTITY_TYPES:
+    OPERATIONS.update({
+        'create_%s' % _entity_type: ((_entity_type,), None),
+        'update_%s' % _entity_type: (('old_%s' % _entity_type,
+                                      _entity_type), None),
+        'delete_%s' % _entity_type: ((_entity_type,), None),
+    })
+
+
+class _LogArguments(object):
+    """Arguments of a cast, abbreviated only when they are logged."""
+
+    _repr = reprlib.Repr()
+    _repr.maxlevel = 4
+    _repr.maxdict = 16
+    _repr.maxlist = 8
+    _repr.maxstring = 64
+    _repr.maxother = 64
+
+    def __init__(self, args):
+        self.args = args
+
+    def __str__(self):
+        text = self._repr.repr(self.args)
+        max_length = cfg.CONF.f5_bigiq_rpc_log_max_length
+        if len(text) > max_length:
+            text = text[:max_length] + '...'
+        return text
+
 
 class BIGIQAgentRPC(object):
 
@@ -15,6 +87,16 @@ class BIGIQAgentRPC(object):
         self.driver = driver
         self.topic = constants.TOPIC_LBAASV2_BIGIQ_AGENT
         self._create_rpc_publisher()
+        # Prepared clients by their prepare() options
+        self._callees = {}
+        self._callees_lock = threading.Lock()
+        registry.subscribe(self._agent_deleted, resources.AGENT,
+                           events.BEFORE_DELETE)
+        # Configurations of the agents met so far, by host
+        self._agent_configurations = {}
+        self.cast_pool = None
+        if cfg.CONF.f5_bigiq_rpc_dispatch_mode == 'async':
+            self.cast_pool = cast_pool.CastPool()
 
     def _create_rpc_publisher(self):
         self.topic = constants.TOPIC_LBAASV2_BIGIQ_AGENT
@@ -22,6 +104,36 @@ class BIGIQAgentRPC(object):
                                   version=constants.RPC_API_VERSION)
         self._client = rpc.get_client(target, version_cap=None)
 
+    @staticmethod
+    def _supports(configurations, version):
+        agent_version = configurations.get(
+            'rpc_api_version', constants.RPC_API_VERSION)
+        return _version_is_compatible(agent_version, version)
+
+    @classmethod
+    def supports(cls, agent, version):
+        """Whether an agent implements the given RPC API version."""
+        return cls._supports(
+            agent_scheduler.get_agent_configurations(agent), version)
+
+    def register_agent(self, agent):
+        """Remember what an agent supports, for the casts to its host."""
+        self._agent_configurations[agent['host']] = \
+            agent_scheduler.get_agent_configurations(agent)
+
+    def _host_supports(self, host, version):
+        configurations = self._agent_configurations.get(host)
+        return configurations is not None and \
+            self._supports(configurations, version)
+
+    def _compression_encoding(self, host):
+        """Return the encoding to compress casts to a host with, if any."""
+        if not cfg.CONF.f5_bigiq_rpc_compression or not self._host_supports(
+                host, constants.RPC_API_VERSION_COMPRESSION):
+            return None
+        return compression.choose_encoding(
+            self._agent_configurations[host].get('compression_encodings'))
+
     def make_msg(self, method, **kwargs):
         return {'method': method,
                 'namespace': constants.RPC_API_NAMESPACE,
@@ -32,11 +144,62 @@ class BIGIQAgentRPC(object):
             context, msg, rpc_method='call', **kwargs)
 
     def cast(self, context, msg, **kwargs):
-        self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
+        self.__cast(context, msg, **kwargs)
 
     def fanout_cast(self, context, msg, **kwargs):
         kwargs['fanout'] = True
-        self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
+        self.__cast(context, msg, **kwargs)
+
+    def __cast(self, context, msg, **kwargs):
+        failed_statuses = kwargs.pop('failed_statuses', None)
+        if self.cast_pool is not None:
+            self.cast_pool.submit(self.__send_queued, context, msg,
+                                  failed_statuses, **kwargs)
+        else:
+            self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
+
+    def __send_queued(self, context, msg, failed_statuses, **kwargs):
+        try:
+            self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
+        except Exception as e:
+            LOG.error('Failed to cast %s to the BIG-IQ agents: %s',
+                      msg['method'], e)
+            if failed_statuses and self.driver is not None:
+                # The request is over, and so is the DB session of its
+                # context. Keep its request id for tracing.
+                context = neutron_context.Context(
+                    user_id=None, tenant_id=None, is_admin=True,
+                    overwrite=False,
+                    request_id=getattr(context, 'request_id', None))
+                self.driver.plugin_rpc.update_statuses(
+                    context, statuses=failed_statuses)
+
+    def stop(self):
+        """Send the casts still queued in async dispatch mode."""
+        if self.cast_pool is not None:
+            self.cast_pool.stop()
+
+    def _get_callee(self, options):
+        if not options:
+            return self._client
+        key = tuple(sorted(options.items()))
+        callee = self._callees.get(key)
+        if callee is None:
+            callee = self._client.prepare(**options)
+            with self._callees_lock:
+                self._callees[key] = callee
+        return callee
+
+    def _agent_deleted(self, resource, event, trigger, **kwargs):
+        agent = kwargs.get('agent')
+        if agent is None or \
+                agent['agent_type'] != constants.LBAASV2_BIGIQ_AGENT_TYPE:
+            return
+        topic = '%s.%s' % (self.topic, agent['host'])
+        with self._callees_lock:
+            for key in [key for key in self._callees
+                        if ('topic', topic) in key]:
+                del self._callees[key]
 
     def __call_rpc_method(self, context, msg, **kwargs):
         options = dict(
@@ -47,301 +210,125 @@ class BIGIQAgentRPC(object):
         if msg['namespace']:
             options['namespace'] = msg['namespace']
 
-        if options:
-            callee = self._client.prepare(**options)
-        else:
-            callee = self._client
-
+        callee = self._get_callee(options)
         func = getattr(callee, kwargs['rpc_method'])
-        return func(context, msg['method'], **msg['args'])
-
-    @log_helpers.log_method_call
-    def create_loadbalancer(self, context, host, loadbalancer, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_loadbalancer',
-                loadbalancer=loadbalancer,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_loadbalancer(
-            self,
-            context,
-            host,
-            old_loadbalancer,
-            loadbalancer,
-            **kwargs
-    ):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_loadbalancer',
-                old_loadbalancer=old_loadbalancer,
-                loadbalancer=loadbalancer,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_loadbalancer(self, context, host, loadbalancer, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_loadbalancer',
-                loadbalancer=loadbalancer,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_loadbalancer_stats(
-            self,
-            context,
-            host,
-            loadbalancer,
-            **kwargs
-    ):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_loadbalancer_stats',
-                loadbalancer=loadbalancer,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_listener(self, context, host, listener, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_listener',
-                listener=listener,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_listener(self, context, host, old_listener, listener, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_listener',
-                old_listener=old_listener,
-                listener=listener,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_listener(self, context, host, listener, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_listener',
-                listener=listener,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_pool(self, context, host, pool, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_pool',
-                pool=pool,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_pool(self, context, host, old_pool, pool, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_pool',
-                old_pool=old_pool,
-                pool=pool,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_pool(self, context, host, pool, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_pool',
-                pool=pool,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_member(self, context, host, member, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_member',
-                member=member,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_member(self, context, host, old_member, member, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_member',
-                old_member=old_member,
-                member=member,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_member(self, context, host, member, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_member',
-                member=member,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_health_monitor(self, context, host, health_monitor, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_health_monitor',
-                health_monitor=health_monitor,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_health_monitor(
-            self,
-            context,
-            host,
-            old_health_monitor,
-            health_monitor,
-            **kwargs
-    ):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_health_monitor',
-                old_health_monitor=old_health_monitor,
-                health_monitor=health_monitor,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_health_monitor(self, context, host, health_monitor, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_health_monitor',
-                health_monitor=health_monitor,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_l7policy(self, context, host, l7policy, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_l7policy',
-                l7policy=l7policy,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_l7policy(self, context, host, old_l7policy, l7policy, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_l7policy',
-                old_l7policy=old_l7policy,
-                l7policy=l7policy,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_l7policy(self, context, host, l7policy, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_l7policy',
-                l7policy=l7policy,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def create_l7rule(self, context, host, l7rule, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'create_l7rule',
-                l7rule=l7rule,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def update_l7rule(self, context, host, old_l7rule, l7rule, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'update_l7rule',
-                old_l7rule=old_l7rule,
-                l7rule=l7rule,
-                **kwargs
-            ),
-            topic=topic)
-
-    @log_helpers.log_method_call
-    def delete_l7rule(self, context, host, l7rule, **kwargs):
-        topic = '%s.%s' % (self.topic, host)
-        return self.cast(
-            context,
-            self.make_msg(
-                'delete_l7rule',
-                l7rule=l7rule,
-                **kwargs
-            ),
-            topic=topic)
+        start = time.time()
+        try:
+            return func(context, msg['method'], **msg['args'])
+        except Exception:
+            metrics.RPC_CAST_ERRORS.inc(method=msg['method'])
+            raise
+        finally:
+            metrics.RPC_CAST_SECONDS.observe(time.time() - start,
+                                             method=msg['method'])
+
+
+def _parse_version(version):
+    return tuple(int(part) for part in version.split('.'))
+
+
+def _version_is_compatible(implemented, version):
+    # As an oslo.messaging RPC server checks a call: same major version,
+    # and a minor version at least the one required.
+    implemented = _parse_version(implemented)
+    version = _parse_version(version)
+    return implemented[0] == version[0] and implemented[1:] >= version[1:]
+
+
+def _failed_statuses(method, args):
+    """Return the statuses to set when a queued cast fails to be sent.
+
+    What the plugin does when the driver raises: the entities go to ERROR
+    and their loadbalancer back to ACTIVE. Casts which change no entity,
+    like sync_services, set none and are left to the reconciler.
+    """
+    if method == 'update_delta':
+        entities = [(args['entity_type'], args['entity_id'])]
+        loadbalancer_id = args['loadbalancer_id']
+    elif method == 'batch_members':
+        entities = [('member', operation['member']['id'])
+                    for operation in args['members']]
+        loadbalancer_id = args['loadbalancer']['id']
+    else:
+        operation, _, entity_type = method.partition('_')
+        if operation not in ('create', 'update', 'delete') or \
+                entity_type not in ENTITY_TYPES:
+            return []
+        entities = [(entity_type, args[entity_type]['id'])]
+        if entity_type == 'loadbalancer':
+            loadbalancer_id = None
+        else:
+            loadbalancer_id = args['loadbalancer']['id']
+    statuses = [(entity_type, entity_id, q_const.ERROR, None)
+                for entity_type, entity_id in entities]
+    if loadbalancer_id is not None:
+        statuses.append(('loadbalancer', loadbalancer_id, q_const.ACTIVE,
+                         None))
+    return statuses
+
+
+def _max_version(*versions):
+    return max((v for v in versions if v), key=_parse_version)
+
+
+def _make_cast_method(method, arg_names, version):
+    def cast_method(self, context, host, *args, **kwargs):
+        if len(args) > len(arg_names):
+            raise TypeError('%s() takes at most %d arguments after host' %
+                            (method, len(arg_names)))
+        msg_args = dict(zip(arg_names, args))
+        for name in msg_args:
+            if name in kwargs:
+                raise TypeError('%s() got multiple values for argument %s' %
+                                (method, name))
+        msg_args.update(kwargs)
+        missing = [name for name in arg_names if name not in msg_args]
+        if missing:
+            raise TypeError('%s() missing arguments: %s' %
+                            (method, ', '.join(missing)))
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Cast %s to agent %s with arguments %s', method, host,
+                      _LogArguments(msg_args))
+
+        cast_options = {'topic': '%s.%s' % (self.topic, host)}
+        if version:
+            cast_options['version'] = version
+        if self.cast_pool is not None:
+            # Taken before the arguments get a trace or are compressed
+            cast_options['failed_statuses'] = _failed_statuses(method,
+                                                               msg_args)
+
+        if self._host_supports(host, constants.RPC_API_VERSION_TRACING):
+            msg_args['trace'] = tracing.make_trace(context, method)
+            cast_options['version'] = _max_version(
+                version, constants.RPC_API_VERSION_TRACING)
+
+        if metrics.sample_payload():
+            metrics.RPC_PAYLOAD_BYTES.observe(
+                len(jsonutils.dump_as_bytes(msg_args)), method=method)
+
+        encoding = None
+        if method in COMPRESSIBLE:
+            encoding = self._compression_encoding(host)
+        if encoding:
+            compressed = compression.compress(msg_args, encoding)
+            if compressed is not msg_args:
+                msg_args = compressed
+                cast_options['version'] = _max_version(
+                    cast_options.get('version'),
+                    constants.RPC_API_VERSION_COMPRESSION)
+
+        metrics.RPC_CASTS.inc(method=method)
+        return self.cast(context, self.make_msg(method, **msg_args),
+                         **cast_options)
+
+    cast_method.__name__ = str(method)
+    cast_method.__doc__ = 'Cast %s(%s) to the BIG-IQ agent of a host.' % (
+        method, ', '.join(arg_names))
+    return cast_method
+
+
+for _method, (_arg_names, _version) in OPERATIONS.items():
+    setattr(BIGIQAgentRPC, _method,
+            _make_cast_method(_method, _arg_names, _version))
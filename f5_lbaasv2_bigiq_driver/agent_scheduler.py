@@ -0,0 +1,319 @@
+import abc
+import bisect
+import hashlib
+import random
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+import six
+from sqlalchemy import func
+
+from neutron.db.models import agent as agents_db
+from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import exceptions
+from f5_lbaasv2_bigiq_driver import metrics
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.StrOpt(
+        'f5_bigiq_agent_group',
+        default=None,
+        help=('Group of the BIG-IQ agents loadbalancers are scheduled to, '
+              'matched against agent_group in the agent configurations, '
+              'e.g. an environment or a BIG-IQ cluster. Unset schedules to '
+              'agents of any group.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_hash_ring_replicas',
+        default=100,
+        help=('Points on the hash ring of ConsistentHashScheduler for each '
+              'unit of agent weight.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+AGENT_ROLE_ACTIVE = 'active'
+AGENT_ROLE_STANDBY = 'standby'
+
+
+def get_agent_configurations(agent):
+    """Return the configurations reported by an agent as a dict."""
+    configurations = agent['configurations']
+    if isinstance(configurations, dict):
+        return configurations
+    try:
+        return jsonutils.loads(configurations or '{}')
+    except ValueError:
+        LOG.warning('Invalid configurations of agent %s', agent['host'])
+        return {}
+
+
+def get_agent_group(agent):
+    return get_agent_configurations(agent).get('agent_group')
+
+
+def get_agent_role(agent):
+    """Return the role of an agent in its group, active by default."""
+    return get_agent_configurations(agent).get('agent_role',
+                                               AGENT_ROLE_ACTIVE)
+
+
+def get_loadbalancer_counts(context, agent_ids):
+    """Return a dict of agent id to the number of bound loadbalancers."""
+    binding = agent_scheduler.LoadbalancerAgentBinding
+    query = context.session.query(
+        binding.agent_id, func.count(binding.loadbalancer_id))
+    query = query.filter(binding.agent_id.in_(agent_ids))
+    query = query.group_by(binding.agent_id)
+    counts = dict.fromkeys(agent_ids, 0)
+    counts.update(dict(query))
+    return counts
+
+
+@six.add_metaclass(abc.ABCMeta)
+class BIGIQAgentScheduler(object):
+    """Base class of loadbalancer to BIG-IQ agent schedulers."""
+
+    def _get_candidates(self, context, in_group):
+        query = context.session.query(agents_db.Agent)
+        query = query.filter_by(agent_type=constants.LBAASV2_BIGIQ_AGENT_TYPE,
+                                admin_state_up=True)
+        candidates = [agent for agent in query
+                      if agent.is_active and in_group(agent)]
+        active = [agent for agent in candidates
+                  if get_agent_role(agent) != AGENT_ROLE_STANDBY]
+        return active or candidates
+
+    def get_candidates(self, context):
+        """Return the agents eligible to host a new loadbalancer.
+
+        Those are the live agents of the configured group. Standby agents
+        of the group are eligible only when none of its active agents is.
+        """
+        group = cfg.CONF.f5_bigiq_agent_group
+        return self._get_candidates(
+            context,
+            lambda agent: group is None or get_agent_group(agent) == group)
+
+    def get_group_candidates(self, context, group):
+        """Return the eligible agents of a group, None for no group.
+
+        Whatever the configured group, e.g. to take over the
+        loadbalancers of a dead agent of the group.
+        """
+        return self._get_candidates(
+            context, lambda agent: get_agent_group(agent) == group)
+
+    @abc.abstractmethod
+    def select(self, context, loadbalancer, candidates):
+        """Return one of the candidates to host the loadbalancer."""
+
+    def select_many(self, context, loadbalancers, candidates):
+        """Return a dict of loadbalancer id to the candidate to host it.
+
+        For loadbalancers bound together once all are selected, like those
+        of a dead agent. Loadbalancers no candidate can host are left out.
+        """
+        selected = {}
+        for loadbalancer in loadbalancers:
+            agent = self.select(context, loadbalancer, candidates)
+            if agent is not None:
+                selected[loadbalancer.id] = agent
+        return selected
+
+    def schedule(self, context, loadbalancer):
+        """Choose a BIG-IQ agent for a new loadbalancer."""
+        candidates = self.get_candidates(context)
+        agent = None
+        if candidates:
+            agent = self.select(context, loadbalancer, candidates)
+        if agent is None:
+            metrics.SCHEDULER_FAILURES.inc(
+                scheduler=self.__class__.__name__)
+            raise exceptions.NoEligibleBIGIQAgent(
+                loadbalancer_id=loadbalancer.id
+            )
+
+        metrics.SCHEDULER_DECISIONS.inc(scheduler=self.__class__.__name__,
+                                        agent=agent['host'])
+        LOG.debug('Scheduled loadbalancer %s to agent %s by %s',
+                  loadbalancer.id, agent['host'], self.__class__.__name__)
+        return agent
+
+
+class LeastLoadedScheduler(BIGIQAgentScheduler):
+    """Schedule to the agent hosting the fewest loadbalancers."""
+
+    def select(self, context, loadbalancer, candidates):
+        counts = get_loadbalancer_counts(
+            context, [agent.id for agent in candidates])
+        return self._least_loaded(candidates, counts)
+
+    @staticmethod
+    def _least_loaded(candidates, counts):
+        fewest = min(counts[agent.id] for agent in candidates)
+        # Break ties randomly, so that concurrent API workers do not all
+        # pick the same agent before any of their bindings are visible.
+        return random.choice(
+            [agent for agent in candidates if counts[agent.id] == fewest])
+
+    def select_many(self, context, loadbalancers, candidates):
+        # None of the loadbalancers is bound yet: count those selected so
+        # far, or they would all go to the same agent.
+        counts = get_loadbalancer_counts(
+            context, [agent.id for agent in candidates])
+        selected = {}
+        for loadbalancer in loadbalancers:
+            agent = self._least_loaded(candidates, counts)
+            counts[agent.id] += 1
+            selected[loadbalancer.id] = agent
+        return selected
+
+
+class TenantScheduler(LeastLoadedScheduler):
+    """Keep loadbalancers of a tenant together on the same agent.
+
+    A new loadbalancer goes to the least loaded agent which already hosts
+    loadbalancers of its tenant. If no such agent is eligible, it goes to
+    the least loaded agent of all.
+    """
+
+    @staticmethod
+    def _get_tenant_agent_ids(context, tenant_id):
+        binding = agent_scheduler.LoadbalancerAgentBinding
+        query = context.session.query(binding.agent_id).join(
+            models.LoadBalancer,
+            models.LoadBalancer.id == binding.loadbalancer_id)
+        query = query.filter(models.LoadBalancer.project_id == tenant_id)
+        return set(row.agent_id for row in query.distinct())
+
+    def select(self, context, loadbalancer, candidates):
+        tenant_agent_ids = self._get_tenant_agent_ids(
+            context, loadbalancer.tenant_id)
+        tenant_agents = [agent for agent in candidates
+                         if agent.id in tenant_agent_ids]
+        return super(TenantScheduler, self).select(
+            context, loadbalancer, tenant_agents or candidates)
+
+    def select_many(self, context, loadbalancers, candidates):
+        # Loadbalancers selected so far count, as in LeastLoadedScheduler,
+        # and keep the next ones of their tenant on the same agent.
+        counts = get_loadbalancer_counts(
+            context, [agent.id for agent in candidates])
+        tenant_agent_ids = {}
+        selected = {}
+        for loadbalancer in loadbalancers:
+            agent_ids = tenant_agent_ids.get(loadbalancer.tenant_id)
+            if agent_ids is None:
+                agent_ids = self._get_tenant_agent_ids(
+                    context, loadbalancer.tenant_id)
+                tenant_agent_ids[loadbalancer.tenant_id] = agent_ids
+            tenant_agents = [agent for agent in candidates
+                             if agent.id in agent_ids]
+            agent = self._least_loaded(tenant_agents or candidates, counts)
+            counts[agent.id] += 1
+            agent_ids.add(agent.id)
+            selected[loadbalancer.id] = agent
+        return selected
+
+
+def get_agent_weight(agent):
+    """Return the scheduler_weight of an agent, 1 by default."""
+    try:
+        weight = int(get_agent_configurations(agent).get(
+            'scheduler_weight', 1))
+    except (TypeError, ValueError):
+        weight = 1
+    return max(weight, 0)
+
+
+class WeightedRoundRobinScheduler(BIGIQAgentScheduler):
+    """Rotate loadbalancers over agents in proportion to their weight.
+
+    The weight is the 'scheduler_weight' value in the agent configurations,
+    1 by default. An agent with weight 0 receives no new loadbalancers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current_weights = {}
+
+    def select(self, context, loadbalancer, candidates):
+        weights = dict((agent.id, get_agent_weight(agent))
+                       for agent in candidates)
+        candidates = sorted(
+            [agent for agent in candidates if weights[agent.id] > 0],
+            key=lambda agent: agent.host)
+        if not candidates:
+            return None
+
+        # Smooth weighted round robin, which interleaves the agents instead
+        # of sending a burst of loadbalancers to the heaviest one.
+        with self._lock:
+            current_weights = dict(
+                (agent.id, self._current_weights.get(agent.id, 0) +
+                 weights[agent.id])
+                for agent in candidates)
+            selected = max(candidates,
+                           key=lambda agent: current_weights[agent.id])
+            current_weights[selected.id] -= sum(
+                weights[agent.id] for agent in candidates)
+            self._current_weights = current_weights
+        return selected
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ConsistentHashScheduler(BIGIQAgentScheduler):
+    """Spread loadbalancers over agents by consistent hashing of their id.
+
+    Each agent owns f5_bigiq_hash_ring_replicas points of a hash ring per
+    unit of its scheduler_weight, placed by hashing its host. A
+    loadbalancer goes to the agent owning the first point after the hash
+    of its id. Adding or removing one of N agents thus changes the agent
+    of about 1/N of the loadbalancers, for instance when the loadbalancers
+    of a dead agent are rescheduled.
+    """
+
+    def __init__(self):
+        self.replicas = max(cfg.CONF.f5_bigiq_hash_ring_replicas, 1)
+        self._lock = threading.Lock()
+        self._ring_key = None
+        self._ring = ([], [])
+
+    def _get_ring(self, members):
+        # members is a sorted tuple of (host, weight), the ring of the last
+        # set of agents is kept since it rarely changes.
+        with self._lock:
+            if self._ring_key == members:
+                return self._ring
+        points = []
+        for host, weight in members:
+            for replica in range(weight * self.replicas):
+                points.append((_hash('%s-%d' % (host, replica)), host))
+        points.sort()
+        ring = ([point for point, _ in points], [host for _, host in points])
+        with self._lock:
+            self._ring_key = members
+            self._ring = ring
+        return ring
+
+    def select(self, context, loadbalancer, candidates):
+        agents = dict((agent.host, agent) for agent in candidates)
+        members = tuple(sorted(
+            (agent.host, get_agent_weight(agent)) for agent in candidates))
+        points, hosts = self._get_ring(
+            tuple(member for member in members if member[1] > 0))
+        if not points:
+            return None
+        index = bisect.bisect(points, _hash(loadbalancer.id)) % len(points)
+        return agents[hosts[index]]
@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Thread safe LRU cache whose entries expire after a TTL.
+
+    A cache with maxsize 0 is disabled: it stores nothing and every lookup
+    is a miss. A ttl of None or 0 means entries never expire.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, stored_at, now):
+        return bool(self.ttl) and now - stored_at >= self.ttl
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or self._expired(entry[1], now):
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def pop_if(self, predicate):
+        """Remove the entries for which predicate(key, value) is true."""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items()
+                    if predicate(key, entry[0])]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
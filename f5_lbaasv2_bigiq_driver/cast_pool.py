@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue
+
+from f5_lbaasv2_bigiq_driver import exceptions
+from f5_lbaasv2_bigiq_driver import metrics
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.StrOpt(
+        'f5_bigiq_rpc_dispatch_mode',
+        default='sync',
+        choices=['sync', 'async'],
+        help=('How casts to the BIG-IQ agents are sent. sync sends them '
+              'from the API worker. async hands them to a pool of worker '
+              'threads, so that a slow message broker does not delay API '
+              'requests. A cast which then fails to be sent sets its '
+              'entity to ERROR.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_rpc_workers',
+        default=4,
+        help=('Number of threads sending casts in async dispatch mode.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_rpc_queue_size',
+        default=1000,
+        help=('Maximum number of casts waiting for a worker thread in '
+              'async dispatch mode.')
+    ),
+    cfg.StrOpt(
+        'f5_bigiq_rpc_queue_full_policy',
+        default='block',
+        choices=['block', 'reject'],
+        help=('What to do with a cast when the async dispatch queue is '
+              'full. block waits up to f5_bigiq_rpc_queue_timeout seconds '
+              'for room, reject fails the cast at once.')
+    ),
+    cfg.FloatOpt(
+        'f5_bigiq_rpc_queue_timeout',
+        default=10.0,
+        help=('Seconds a cast waits for room in a full async dispatch '
+              'queue under the block policy before it fails.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'f5_bigiq_rpc_queue_depth',
+    'Casts waiting for a worker thread in async dispatch mode.')
+QUEUE_SECONDS = metrics.REGISTRY.histogram(
+    'f5_bigiq_rpc_queue_seconds',
+    'Time from queuing a cast to sending it in async dispatch mode.')
+QUEUE_REJECTED = metrics.REGISTRY.counter(
+    'f5_bigiq_rpc_queue_rejected_total',
+    'Casts which found no room in the async dispatch queue.')
+
+
+class CastPool(object):
+    """Bounded queue of casts sent by a pool of worker threads.
+
+    Workers are started on the first cast of each process, since threads
+    do not survive the fork of the neutron API workers. Stopping the pool
+    sends the casts still queued.
+    """
+
+    def __init__(self):
+        self.workers = max(cfg.CONF.f5_bigiq_rpc_workers, 1)
+        self.block = cfg.CONF.f5_bigiq_rpc_queue_full_policy == 'block'
+        self.timeout = cfg.CONF.f5_bigiq_rpc_queue_timeout
+        self._queue = queue.Queue(maxsize=cfg.CONF.f5_bigiq_rpc_queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be called by a worker."""
+        if self._pid != os.getpid():
+            self._start()
+        item = (func, args, kwargs, time.time())
+        try:
+            if self.block:
+                self._queue.put(item, timeout=self.timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            QUEUE_REJECTED.inc()
+            raise exceptions.BIGIQAgentRPCQueueFull(
+                size=self._queue.maxsize)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            func, args, kwargs, enqueued_at = item
+            QUEUE_SECONDS.observe(time.time() - enqueued_at)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                LOG.error('Failed to send cast: %s', e)
+            finally:
+                self._queue.task_done()
+
+    def stop(self):
+        """Send the queued casts and stop the workers."""
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(self.timeout)
+        self._threads = []
+        self._pid = None
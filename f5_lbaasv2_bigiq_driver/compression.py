@@ -0,0 +1,79 @@
+import base64
+import zlib
+
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+OPTS = [
+    cfg.BoolOpt(
+        'f5_bigiq_rpc_compression',
+        default=False,
+        help=('Compress the large arguments of the casts carrying many '
+              'entities, like sync_services and batch_members, sent to the '
+              'BIG-IQ agents which support it.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_rpc_compression_threshold',
+        default=65536,
+        help=('Size in bytes of the JSON encoded cast arguments above which '
+              'they are compressed.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_rpc_compression_level',
+        default=3,
+        help=('Compression level, for zlib (1-9) or zstd (1-22).')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+# The only argument of a cast whose arguments are compressed
+ENVELOPE_KEY = 'compressed_payload'
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+
+def available_encodings():
+    if zstandard is not None:
+        return [ZSTD, ZLIB]
+    return [ZLIB]
+
+
+def choose_encoding(agent_encodings):
+    """Return the best encoding both sides support.
+
+    Every agent supporting compression can decode zlib, while zstd is used
+    only with the agents listing it.
+    """
+    for encoding in available_encodings():
+        if encoding == ZLIB or encoding in (agent_encodings or []):
+            return encoding
+    return ZLIB
+
+
+def compress(args, encoding):
+    """Return args, in a compression envelope if they are large enough.
+
+    The envelope replaces all the arguments with a single
+    compressed_payload argument holding the encoding, the size of the JSON
+    encoded arguments and their base64 encoded compressed form.
+    """
+    payload = jsonutils.dump_as_bytes(args)
+    if len(payload) < cfg.CONF.f5_bigiq_rpc_compression_threshold:
+        return args
+
+    level = cfg.CONF.f5_bigiq_rpc_compression_level
+    if encoding == ZSTD:
+        data = zstandard.ZstdCompressor(level=level).compress(payload)
+    else:
+        data = zlib.compress(payload, min(max(level, 1), 9))
+    envelope = {'encoding': encoding,
+                'size': len(payload),
+                'data': base64.b64encode(data).decode('ascii')}
+    return {ENVELOPE_KEY: envelope}
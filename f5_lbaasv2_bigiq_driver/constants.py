@@ -5,3 +5,17 @@ TOPIC_LBAASV2_BIGIQ_DRIVER = "f5-lbaasv2-bigiq-driver"
 TOPIC_LBAASV2_BIGIQ_AGENT = "f5-lbaasv2-bigiq-agent"
 RPC_API_VERSION = '1.0'
 RPC_API_NAMESPACE = None
+
+# Minimum agent RPC API versions of optional features. A BIG-IQ agent
+# advertises its version as rpc_api_version in the agent configurations.
+RPC_API_VERSION_BATCH_MEMBERS = '1.1'
+# Agents of version 1.2 apply update_delta casts, whose changes hold the
+# changed keys of the entity and the list of its removed keys.
+RPC_API_VERSION_DELTA_UPDATE = '1.2'
+RPC_API_VERSION_SYNC_SERVICES = '1.3'
+# Agents of version 1.4 decode zlib compression envelopes, and zstd ones
+# too when they list it in compression_encodings of their configurations.
+RPC_API_VERSION_COMPRESSION = '1.4'
+# Agents of version 1.5 accept a trace argument in every cast and echo it
+# in the status callbacks of the entity.
+RPC_API_VERSION_TRACING = '1.5'
@@ -0,0 +1,303 @@
+from neutron_lib import constants as plugin_constants
+from sqlalchemy import sql
+
+from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import constants as lb_const
+
+# Largest number of ids in one IN clause
+MAX_IDS_PER_QUERY = 500
+
+# Resource type to (model, keep_pending_delete). When keep_pending_delete
+# is true, a resource in PENDING_DELETE keeps that provisioning status but
+# still gets its operating status updated. Otherwise a resource in
+# PENDING_DELETE is not updated at all.
+STATUS_MODELS = {
+    'loadbalancer': (models.LoadBalancer, True),
+    'listener': (models.Listener, True),
+    'pool': (models.PoolV2, False),
+    'member': (models.MemberV2, False),
+    'health_monitor': (models.HealthMonitorV2, False),
+    'l7policy': (models.L7Policy, True),
+    'l7rule': (models.L7Rule, True),
+}
+
+
+def chunks(items, size=MAX_IDS_PER_QUERY):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def update_statuses(session, resource_type, ids, provisioning_status=None,
+                    operating_status=None):
+    """Set the status of many resources of one type with set-based UPDATEs.
+
+    Follows the PENDING_DELETE rules of STATUS_MODELS and, like the
+    plugin's update_status, leaves a status alone when it is None or the
+    model has no such column. Returns the number of rows updated.
+    """
+    model, keep_pending_delete = STATUS_MODELS[resource_type]
+
+    values = {}
+    if provisioning_status and hasattr(model, 'provisioning_status'):
+        if keep_pending_delete:
+            values['provisioning_status'] = sql.case(
+                [(model.provisioning_status ==
+                  plugin_constants.PENDING_DELETE,
+                  plugin_constants.PENDING_DELETE)],
+                else_=provisioning_status)
+        else:
+            values['provisioning_status'] = provisioning_status
+    if operating_status and hasattr(model, 'operating_status'):
+        values['operating_status'] = operating_status
+    if not values:
+        return 0
+
+    updated = 0
+    for chunk in chunks(ids):
+        query = session.query(model).filter(model.id.in_(chunk))
+        if not keep_pending_delete:
+            query = query.filter(model.provisioning_status !=
+                                 plugin_constants.PENDING_DELETE)
+        updated += query.update(values, synchronize_session=False)
+    return updated
+
+
+PENDING_STATUSES = (plugin_constants.PENDING_CREATE,
+                    plugin_constants.PENDING_UPDATE,
+                    plugin_constants.PENDING_DELETE)
+
+
+def _pending_query(session, resource_type):
+    # Query of (id, loadbalancer_id, provisioning_status) of a resource type
+    if resource_type == 'loadbalancer':
+        model = models.LoadBalancer
+        query = session.query(model.id, model.id.label('loadbalancer_id'),
+                              model.provisioning_status)
+    elif resource_type in ('listener', 'pool'):
+        model = STATUS_MODELS[resource_type][0]
+        query = session.query(model.id, model.loadbalancer_id,
+                              model.provisioning_status)
+    elif resource_type == 'member':
+        model = models.MemberV2
+        query = session.query(model.id, models.PoolV2.loadbalancer_id,
+                              model.provisioning_status)
+        query = query.join(models.PoolV2, models.PoolV2.id == model.pool_id)
+    elif resource_type == 'health_monitor':
+        model = models.HealthMonitorV2
+        query = session.query(model.id, models.PoolV2.loadbalancer_id,
+                              model.provisioning_status)
+        query = query.join(models.PoolV2,
+                           models.PoolV2.healthmonitor_id == model.id)
+    elif resource_type == 'l7policy':
+        model = models.L7Policy
+        query = session.query(model.id, models.Listener.loadbalancer_id,
+                              model.provisioning_status)
+        query = query.join(models.Listener,
+                           models.Listener.id == model.listener_id)
+    else:
+        model = models.L7Rule
+        query = session.query(model.id, models.Listener.loadbalancer_id,
+                              model.provisioning_status)
+        query = query.join(models.L7Policy,
+                           models.L7Policy.id == model.l7policy_id)
+        query = query.join(models.Listener,
+                           models.Listener.id == models.L7Policy.listener_id)
+    return query.filter(model.provisioning_status.in_(PENDING_STATUSES))
+
+
+def get_pending_resources(session):
+    """Return the resources in a PENDING_* provisioning status.
+
+    Returns a list of (resource_type, id, loadbalancer_id,
+    provisioning_status) tuples, with one query per resource type.
+    """
+    resources = []
+    for resource_type in STATUS_MODELS:
+        resources.extend(
+            (resource_type, row.id, row.loadbalancer_id,
+             row.provisioning_status)
+            for row in _pending_query(session, resource_type))
+    return resources
+
+
+def rebind_loadbalancers(session, loadbalancer_ids, from_agent_id,
+                         to_agent_id):
+    """Move loadbalancers from one agent to another with set-based UPDATEs.
+
+    Only the bindings still on from_agent_id are moved, so that concurrent
+    rebinds of the same loadbalancers by other workers move each of them
+    once. Returns the number of bindings moved.
+    """
+    binding = agent_scheduler.LoadbalancerAgentBinding
+    moved = 0
+    for chunk in chunks(loadbalancer_ids):
+        query = session.query(binding).filter(
+            binding.loadbalancer_id.in_(chunk),
+            binding.agent_id == from_agent_id)
+        moved += query.update({'agent_id': to_agent_id},
+                              synchronize_session=False)
+    return moved
+
+
+def _delete_in(session, model, column, ids):
+    deleted = 0
+    for chunk in chunks(ids):
+        deleted += session.query(model).filter(column.in_(chunk)).delete(
+            synchronize_session=False)
+    return deleted
+
+
+def delete_loadbalancer_tree(session, loadbalancer_id):
+    """Delete a loadbalancer and all its children with set-based DELETEs.
+
+    Rows are deleted children first, so that no foreign key is violated.
+    Must run in a transaction. Returns the id of the VIP port of the
+    loadbalancer, which is left to the caller to delete, or None if there
+    is no such port or loadbalancer.
+    """
+    loadbalancer = session.query(models.LoadBalancer.vip_port_id).filter(
+        models.LoadBalancer.id == loadbalancer_id).first()
+    if loadbalancer is None:
+        return None
+
+    listener_ids = [row.id for row in session.query(models.Listener.id).filter(
+        models.Listener.loadbalancer_id == loadbalancer_id)]
+    pools = session.query(models.PoolV2.id, models.PoolV2.healthmonitor_id)
+    pools = pools.filter(models.PoolV2.loadbalancer_id == loadbalancer_id)
+    pools = pools.all()
+    pool_ids = [pool.id for pool in pools]
+    l7policy_ids = []
+    for chunk in chunks(listener_ids):
+        l7policy_ids.extend(
+            row.id for row in session.query(models.L7Policy.id).filter(
+                models.L7Policy.listener_id.in_(chunk)))
+
+    _delete_in(session, models.L7Rule, models.L7Rule.l7policy_id,
+               l7policy_ids)
+    _delete_in(session, models.L7Policy, models.L7Policy.id, l7policy_ids)
+    _delete_in(session, models.SNI, models.SNI.listener_id, listener_ids)
+    _delete_in(session, models.Listener, models.Listener.id, listener_ids)
+    _delete_in(session, models.MemberV2, models.MemberV2.pool_id, pool_ids)
+    _delete_in(session, models.SessionPersistenceV2,
+               models.SessionPersistenceV2.pool_id, pool_ids)
+    _delete_in(session, models.PoolV2, models.PoolV2.id, pool_ids)
+    _delete_in(session, models.HealthMonitorV2, models.HealthMonitorV2.id,
+               [pool.healthmonitor_id for pool in pools
+                if pool.healthmonitor_id])
+    _delete_in(session, models.LoadBalancerStatistics,
+               models.LoadBalancerStatistics.loadbalancer_id,
+               [loadbalancer_id])
+    binding = agent_scheduler.LoadbalancerAgentBinding
+    _delete_in(session, binding, binding.loadbalancer_id, [loadbalancer_id])
+    _delete_in(session, models.LoadBalancer, models.LoadBalancer.id,
+               [loadbalancer_id])
+    return loadbalancer.vip_port_id or None
+
+
+# Resource types in the order bulk deletes run, children first
+DELETE_ORDER = ('l7rule', 'l7policy', 'member', 'health_monitor', 'listener',
+                'pool', 'loadbalancer')
+
+
+def _delete_l7policies(session, l7policy_ids):
+    _delete_in(session, models.L7Rule, models.L7Rule.l7policy_id,
+               l7policy_ids)
+    return _delete_in(session, models.L7Policy, models.L7Policy.id,
+                      l7policy_ids)
+
+
+def _delete_health_monitors(session, health_monitor_ids):
+    for chunk in chunks(health_monitor_ids):
+        session.query(models.PoolV2).filter(
+            models.PoolV2.healthmonitor_id.in_(chunk)).update(
+            {'healthmonitor_id': None}, synchronize_session=False)
+    return _delete_in(session, models.HealthMonitorV2,
+                      models.HealthMonitorV2.id, health_monitor_ids)
+
+
+def _delete_listeners(session, listener_ids):
+    l7policy_ids = []
+    for chunk in chunks(listener_ids):
+        l7policy_ids.extend(
+            row.id for row in session.query(models.L7Policy.id).filter(
+                models.L7Policy.listener_id.in_(chunk)))
+    _delete_l7policies(session, l7policy_ids)
+    _delete_in(session, models.SNI, models.SNI.listener_id, listener_ids)
+    return _delete_in(session, models.Listener, models.Listener.id,
+                      listener_ids)
+
+
+def _delete_pools(session, pool_ids):
+    # As the plugin's delete_pool: listeners lose their default pool, and
+    # L7 policies redirecting to the pool reject instead.
+    redirect = lb_const.L7_POLICY_ACTION_REDIRECT_TO_POOL
+    health_monitor_ids = []
+    for chunk in chunks(pool_ids):
+        health_monitor_ids.extend(
+            row.healthmonitor_id for row in
+            session.query(models.PoolV2.healthmonitor_id).filter(
+                models.PoolV2.id.in_(chunk),
+                models.PoolV2.healthmonitor_id.isnot(None)))
+        session.query(models.Listener).filter(
+            models.Listener.default_pool_id.in_(chunk)).update(
+            {'default_pool_id': None}, synchronize_session=False)
+        session.query(models.L7Policy).filter(
+            models.L7Policy.redirect_pool_id.in_(chunk)).update(
+            {'redirect_pool_id': None,
+             'action': sql.case(
+                 [(models.L7Policy.action == redirect,
+                   lb_const.L7_POLICY_ACTION_REJECT)],
+                 else_=models.L7Policy.action)},
+            synchronize_session=False)
+    _delete_in(session, models.MemberV2, models.MemberV2.pool_id, pool_ids)
+    _delete_in(session, models.SessionPersistenceV2,
+               models.SessionPersistenceV2.pool_id, pool_ids)
+    deleted = _delete_in(session, models.PoolV2, models.PoolV2.id, pool_ids)
+    # Health monitors are not listed when a whole tree is destroyed
+    _delete_in(session, models.HealthMonitorV2, models.HealthMonitorV2.id,
+               health_monitor_ids)
+    return deleted
+
+
+def delete_resources(session, resources):
+    """Delete resources of several types with set-based DELETEs.
+
+    resources maps resource types to lists of ids. Types are deleted in
+    DELETE_ORDER, each with the children the plugin would delete with it.
+    Must run in a transaction. Returns a dict of resource type to the
+    number of rows deleted, and the ids of the VIP ports of the deleted
+    loadbalancers, which are left to the caller to delete.
+    """
+    deleted = {}
+    vip_port_ids = []
+    for resource_type in DELETE_ORDER:
+        ids = list(set(resources.get(resource_type) or []))
+        if not ids:
+            continue
+        if resource_type == 'l7rule':
+            count = _delete_in(session, models.L7Rule, models.L7Rule.id, ids)
+        elif resource_type == 'l7policy':
+            count = _delete_l7policies(session, ids)
+        elif resource_type == 'member':
+            count = _delete_in(session, models.MemberV2, models.MemberV2.id,
+                               ids)
+        elif resource_type == 'health_monitor':
+            count = _delete_health_monitors(session, ids)
+        elif resource_type == 'listener':
+            count = _delete_listeners(session, ids)
+        elif resource_type == 'pool':
+            count = _delete_pools(session, ids)
+        else:
+            count = 0
+            for loadbalancer_id in ids:
+                if session.query(models.LoadBalancer.id).filter(
+                        models.LoadBalancer.id == loadbalancer_id).first():
+                    count += 1
+                    vip_port_id = delete_loadbalancer_tree(session,
+                                                           loadbalancer_id)
+                    if vip_port_id:
+                        vip_port_ids.append(vip_port_id)
+        deleted[resource_type] = count
+    return deleted, vip_port_ids
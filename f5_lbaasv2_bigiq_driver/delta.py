@@ -0,0 +1,16 @@
+def diff(old, new):
+    """Return the changes from an old API dict to a new one.
+
+    The changes hold 'changed', a dict of the keys whose value changed or
+    which were added with their new value, and 'removed', the sorted list
+    of the keys no longer there. A key set to None is changed, not
+    removed. Nested dicts and lists are replaced as a whole.
+    """
+    return {'changed': dict((key, value) for key, value in new.items()
+                            if key not in old or old[key] != value),
+            'removed': sorted(key for key in old if key not in new)}
+
+
+def is_empty(changes):
+    """Whether changes returned by diff change nothing."""
+    return not changes['changed'] and not changes['removed']
@@ -0,0 +1,50 @@
+from f5_lbaasv2_bigiq_driver import metrics
+from f5_lbaasv2_bigiq_driver import serializer
+
+DISPATCH_DEPTH = metrics.REGISTRY.gauge(
+    'f5_bigiq_dispatch_depth',
+    'Entity operations of API requests being sent to the BIG-IQ agents.')
+
+
+class Operation(object):
+    """A create, update or delete of an entity by an EntityManager."""
+
+    def __init__(self, manager, context, operation, entity, old_entity=None,
+                 kwargs=None):
+        self.manager = manager
+        self.context = context
+        self.operation = operation
+        self.entity = entity
+        self.old_entity = old_entity
+        self.kwargs = kwargs or {}
+
+    def send(self):
+        if self.operation == 'create':
+            self.manager.send_create(self.context, self.entity,
+                                     **self.kwargs)
+        elif self.operation == 'update':
+            self.manager.send_update(self.context, self.old_entity,
+                                     self.entity, **self.kwargs)
+        else:
+            self.manager.send_delete(self.context, self.entity,
+                                     **self.kwargs)
+
+
+class Dispatcher(object):
+    """Send entity operations from the API request which made them.
+
+    The plugin sets the loadbalancer of an entity to PENDING_UPDATE on
+    every operation and rejects any other operation on it until its agent
+    reports back. A loadbalancer thus never has two operations to send,
+    and superseded operations cannot be collapsed: each one is sent at
+    once, in the order of the API calls. A failure to send it raises to
+    the plugin, which sets the entity to ERROR.
+    """
+
+    def dispatch(self, operation):
+        DISPATCH_DEPTH.inc()
+        try:
+            with serializer.scope():
+                operation.send()
+        finally:
+            DISPATCH_DEPTH.dec()
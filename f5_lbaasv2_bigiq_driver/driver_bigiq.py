@@ -1,11 +1,12 @@
+import atexit
 import os
 import sys
 
 from oslo_config import cfg
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
+from oslo_utils import importutils
 
-from neutron.db.models import agent as agents_db
 from neutron_lbaas import agent_scheduler
 
 from neutron_lib import constants as q_const
@@ -13,10 +14,23 @@ from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
 from neutron_lib.callbacks import resources
 
+from f5_lbaasv2_bigiq_driver import agent_monitor
 from f5_lbaasv2_bigiq_driver import agent_rpc
+from f5_lbaasv2_bigiq_driver import cache
 from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api
+from f5_lbaasv2_bigiq_driver import delta
+from f5_lbaasv2_bigiq_driver import dispatcher
 from f5_lbaasv2_bigiq_driver import exceptions
+from f5_lbaasv2_bigiq_driver import member_batcher
+from f5_lbaasv2_bigiq_driver import metrics
 from f5_lbaasv2_bigiq_driver import plugin_rpc
+from f5_lbaasv2_bigiq_driver import reconciler
+from f5_lbaasv2_bigiq_driver import serializer
+from f5_lbaasv2_bigiq_driver import service_builder
+from f5_lbaasv2_bigiq_driver import stats
+from f5_lbaasv2_bigiq_driver import status_table
+from f5_lbaasv2_bigiq_driver import tracing
 
 LOG = logging.getLogger(__name__)
 
@@ -26,12 +40,55 @@ OPTS = [
         default=(
             'f5_lbaasv2_bigiq_driver.agent_scheduler.TenantScheduler'
         ),
-        help=('Driver to use for scheduling loadbalancer to a BIG-IQ agent')
+        help=('Driver to use for scheduling loadbalancer to a BIG-IQ '
+              'agent. Available schedulers in the agent_scheduler module '
+              'are TenantScheduler, LeastLoadedScheduler, '
+              'WeightedRoundRobinScheduler and ConsistentHashScheduler.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_binding_cache_size',
+        default=4096,
+        help=('Maximum number of loadbalancer to BIG-IQ agent bindings '
+              'cached in memory. 0 disables the cache.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_binding_cache_ttl',
+        default=30,
+        help=('Seconds a cached loadbalancer to BIG-IQ agent binding, '
+              'including the agent liveness, stays valid.')
+    ),
+    cfg.BoolOpt(
+        'f5_bigiq_delta_updates',
+        default=True,
+        help=('Send only the changed fields of an updated entity to the '
+              'BIG-IQ agents which support it. Other agents always get the '
+              'old and new entities and the whole loadbalancer.')
     )
 ]
 
 cfg.CONF.register_opts(OPTS)
 
+BINDING_CACHE_LOOKUPS = metrics.REGISTRY.counter(
+    'f5_bigiq_binding_cache_lookups_total',
+    'Lookups of loadbalancer to BIG-IQ agent bindings in the cache, by '
+    'result. Each miss reads the binding from the DB.', ('result',))
+BINDING_CACHE_EVICTIONS = metrics.REGISTRY.counter(
+    'f5_bigiq_binding_cache_evictions_total',
+    'Bindings evicted from the full binding cache.')
+BINDING_CACHE_SIZE = metrics.REGISTRY.gauge(
+    'f5_bigiq_binding_cache_size',
+    'Bindings in the binding cache.')
+
+
+def export_binding_cache(binding_cache):
+    """Read the binding cache metrics from the counts of a cache."""
+    BINDING_CACHE_LOOKUPS.set_function(lambda: binding_cache.hits,
+                                       result='hit')
+    BINDING_CACHE_LOOKUPS.set_function(lambda: binding_cache.misses,
+                                       result='miss')
+    BINDING_CACHE_EVICTIONS.set_function(lambda: binding_cache.evictions)
+    BINDING_CACHE_SIZE.set_function(lambda: len(binding_cache))
+
 
 class BIGIQDriver(object):
 
@@ -44,6 +101,28 @@ class BIGIQDriver(object):
         self.plugin = plugin
         self.agent_rpc = agent_rpc.BIGIQAgentRPC(self)
         self.plugin_rpc = plugin_rpc.LBaaSv2PluginCallbacksRPC(self)
+        self.service_builder = service_builder.LBaaSv2ServiceBuilder(self)
+        self.scheduler = importutils.import_object(
+            cfg.CONF.f5_bigiq_agent_scheduler)
+        self.binding_cache = cache.LRUCache(
+            cfg.CONF.f5_bigiq_binding_cache_size,
+            cfg.CONF.f5_bigiq_binding_cache_ttl)
+        export_binding_cache(self.binding_cache)
+        self.member_batcher = member_batcher.MemberBatcher(self.agent_rpc)
+        self.dispatcher = dispatcher.Dispatcher()
+        self.stats_cache = stats.StatsCache()
+        self.stats_writer = stats.StatsWriter(self.plugin)
+        self.agent_monitor = agent_monitor.AgentMonitor(self)
+        self.reconciler = reconciler.Reconciler(self)
+        if self.reconciler.interval > 0:
+            self.plugin.add_worker(
+                reconciler.ReconcilerWorker(self.reconciler))
+        self.metrics_exporter = metrics.MetricsExporter()
+        self.tracer = tracing.Tracer()
+        self.status_table = status_table.StatusTable()
+        # For a neutron-server which does not fork workers. Forked workers
+        # leave without running atexit handlers, see _stop_with_worker.
+        atexit.register(self.stop)
 
         self.loadbalancer = LoadBalancerManager(self)
         self.listener = ListenerManager(self)
@@ -74,42 +153,119 @@ class BIGIQDriver(object):
             LOG.debug("F5DriverV2 received post neutron child "
                       "fork notification pid(%d) print trigger(%s)" % (
                           os.getpid(), trigger))
+            # The trigger is the start method of the worker of this process
+            worker = getattr(trigger, '__self__', None)
+            if worker is not None:
+                self._stop_with_worker(worker)
             self.plugin_rpc.create_rpc_listener()
+            self.stats_writer.start()
+            self.agent_monitor.start()
+            self.metrics_exporter.start()
 
         # post_fork_callback.__name__ += '_' + str(self.env)
         return post_fork_callback
 
+    def _stop_with_worker(self, worker):
+        # oslo.service stops the worker of a forked process on SIGTERM,
+        # then leaves with os._exit(), which skips the atexit handlers.
+        stop_worker = worker.stop
+
+        def stop(*args, **kwargs):
+            try:
+                return stop_worker(*args, **kwargs)
+            finally:
+                self.stop()
+
+        worker.stop = stop
+
+    def stop(self):
+        """Send and write what this process still buffers, stop its loops.
+
+        Run when the worker of a forked process stops, after it stopped
+        taking requests, or at exit otherwise.
+        """
+        self.member_batcher.flush_all()
+        self.agent_rpc.stop()
+        self.stats_writer.stop()
+        self.agent_monitor.stop()
+        self.reconciler.stop()
+        self.metrics_exporter.stop()
+
 
 class EntityManager(object):
 
     def __init__(self, driver):
         self.driver = driver
+        self.entity_type = None
         self.create_entity_rpc = None
         self.update_entity_rpc = None
         self.delete_entity_rpc = None
 
     def _locate_bigiq_agent(self, context, loadbalancer_id):
-        binding = self.driver.plugin.db.get_agent_hosting_loadbalancer(
-            context, loadbalancer_id
-        )
-
-        if binding is None:
-            raise exceptions.NoEligibleBIGIQAgent(
-                loadbalancer_id=loadbalancer_id
+        agent = self.driver.binding_cache.get(loadbalancer_id)
+        if agent is None:
+            LOG.debug('Binding cache miss for loadbalancer %s, cache stats %s',
+                      loadbalancer_id, self.driver.binding_cache.stats())
+            binding = self.driver.plugin.db.get_agent_hosting_loadbalancer(
+                context, loadbalancer_id
             )
 
-        agent = binding['agent']
+            if binding is None:
+                raise exceptions.NoEligibleBIGIQAgent(
+                    loadbalancer_id=loadbalancer_id
+                )
+
+            agent = binding['agent']
+            self.driver.binding_cache.set(loadbalancer_id, agent)
+
         if not agent['alive'] or not agent['admin_state_up']:
             raise exceptions.BIGIQAgentIsNotAlive(
                 loadbalancer_id=loadbalancer_id
             )
 
+        self.driver.agent_rpc.register_agent(agent)
         return agent
 
+    def _dispatch(self, context, operation, entity, old_entity=None,
+                  **kwargs):
+        if not kwargs.get('host'):
+            # Fail the API request at once if no agent can take it
+            self._locate_bigiq_agent(context, kwargs['loadbalancer'].id)
+        self.driver.tracer.start(context, self.entity_type, entity.id,
+                                 operation)
+        # The API changed the status of the entity and its loadbalancer
+        self.driver.status_table.invalidate(self.entity_type, entity.id)
+        self.driver.status_table.invalidate('loadbalancer',
+                                            kwargs['loadbalancer'].id)
+        self.driver.dispatcher.dispatch(dispatcher.Operation(
+            self, context, operation, entity, old_entity=old_entity,
+            kwargs=kwargs))
+
     @log_helpers.log_method_call
     def create(self, context, entity, **kwargs):
         """Create an entity."""
+        self._dispatch(context, 'create', entity, **kwargs)
+
+    @log_helpers.log_method_call
+    def update(self, context, old_entity, entity, **kwargs):
+        """Update an entity."""
+        self._dispatch(context, 'update', entity, old_entity=old_entity,
+                       **kwargs)
+
+    @log_helpers.log_method_call
+    def delete(self, context, entity, **kwargs):
+        """Delete an entity."""
+        self._dispatch(context, 'delete', entity, **kwargs)
+
+    def _flush_members(self, loadbalancer):
+        # Batched member operations go out before any other cast of their
+        # loadbalancer, so that the agent gets them in order.
+        self.driver.member_batcher.flush(loadbalancer.id)
+
+    def send_create(self, context, entity, **kwargs):
+        """Send the create of an entity to its agent."""
         loadbalancer = kwargs['loadbalancer']
+        self._flush_members(loadbalancer)
 
         host = kwargs.get('host')
         if not host:
@@ -118,32 +274,53 @@ class EntityManager(object):
 
         rpc_kwargs = {}
         if entity is not loadbalancer:
-            rpc_kwargs['loadbalancer'] = loadbalancer.to_api_dict()
+            rpc_kwargs['loadbalancer'] = serializer.to_api_dict(loadbalancer)
 
-        self.create_entity_rpc(context, host, entity.to_api_dict(),
+        self.create_entity_rpc(context, host,
+                               serializer.to_api_dict(entity),
                                **rpc_kwargs)
 
-    @log_helpers.log_method_call
-    def update(self, context, old_entity, entity, **kwargs):
-        """Update an entity."""
+    def _supports_delta(self, agent):
+        return cfg.CONF.f5_bigiq_delta_updates and \
+            self.driver.agent_rpc.supports(
+                agent, constants.RPC_API_VERSION_DELTA_UPDATE)
+
+    def send_update(self, context, old_entity, entity, **kwargs):
+        """Send the update of an entity to its agent."""
         loadbalancer = kwargs['loadbalancer']
+        self._flush_members(loadbalancer)
 
         host = kwargs.get('host')
         if not host:
             agent = self._locate_bigiq_agent(context, loadbalancer.id)
             host = agent['host']
+            if self._supports_delta(agent):
+                changes = delta.diff(old_entity.to_api_dict(),
+                                     serializer.to_api_dict(entity))
+                if delta.is_empty(changes):
+                    # Nothing for the agent to do, the update is complete
+                    self.driver.plugin_rpc.update_statuses(context, statuses=[
+                        ('loadbalancer', loadbalancer.id,
+                         q_const.ACTIVE, None),
+                        (self.entity_type, entity.id, q_const.ACTIVE, None)])
+                    return
+                self.driver.agent_rpc.update_delta(
+                    context, host, self.entity_type, entity.id,
+                    loadbalancer.id, changes)
+                return
 
         rpc_kwargs = {}
         if entity is not loadbalancer:
-            rpc_kwargs['loadbalancer'] = loadbalancer.to_api_dict()
+            rpc_kwargs['loadbalancer'] = serializer.to_api_dict(loadbalancer)
 
         self.update_entity_rpc(context, host, old_entity.to_api_dict(),
-                               entity.to_api_dict(), **rpc_kwargs)
+                               serializer.to_api_dict(entity),
+                               **rpc_kwargs)
 
-    @log_helpers.log_method_call
-    def delete(self, context, entity, **kwargs):
-        """Delete an entity."""
+    def send_delete(self, context, entity, **kwargs):
+        """Send the delete of an entity to its agent."""
         loadbalancer = kwargs['loadbalancer']
+        self._flush_members(loadbalancer)
 
         host = kwargs.get('host')
         if not host:
@@ -152,9 +329,10 @@ class EntityManager(object):
 
         rpc_kwargs = {}
         if entity is not loadbalancer:
-            rpc_kwargs['loadbalancer'] = loadbalancer.to_api_dict()
+            rpc_kwargs['loadbalancer'] = serializer.to_api_dict(loadbalancer)
 
-        self.delete_entity_rpc(context, host, entity.to_api_dict(),
+        self.delete_entity_rpc(context, host,
+                               serializer.to_api_dict(entity),
                                **rpc_kwargs)
 
 
@@ -163,32 +341,27 @@ class LoadBalancerManager(EntityManager):
 
     def __init__(self, driver):
         super(LoadBalancerManager, self).__init__(driver)
+        self.entity_type = 'loadbalancer'
         self.create_entity_rpc = self.driver.agent_rpc.create_loadbalancer
         self.update_entity_rpc = self.driver.agent_rpc.update_loadbalancer
         self.delete_entity_rpc = self.driver.agent_rpc.delete_loadbalancer
 
-    def _schedule_bigiq_agent(self, context, loadbalancer_id, active=True):
-        # TODO: agent scheduler
-        query = context.session.query(agents_db.Agent)
-        query = query.filter_by(agent_type=constants.LBAASV2_BIGIQ_AGENT_TYPE,
-                                admin_state_up=active)
-        agents = [agent for agent in query]
-        if len(agents) > 0:
-            # Bind loadbalancer with agent
-            binding = agent_scheduler.LoadbalancerAgentBinding()
-            binding.agent = agents[0]
-            binding.loadbalancer_id = loadbalancer_id
-            context.session.add(binding)
-            return agents[0]
-        else:
-            raise exceptions.NoEligibleBIGIQAgent(
-                loadbalancer_id=loadbalancer_id
-            )
+    def _schedule_bigiq_agent(self, context, loadbalancer):
+        agent = self.driver.scheduler.schedule(context, loadbalancer)
+
+        # Bind loadbalancer with agent
+        binding = agent_scheduler.LoadbalancerAgentBinding()
+        binding.agent = agent
+        binding.loadbalancer_id = loadbalancer.id
+        context.session.add(binding)
+        self.driver.binding_cache.pop(loadbalancer.id)
+        self.driver.agent_rpc.register_agent(agent)
+        return agent
 
     @log_helpers.log_method_call
     def create(self, context, loadbalancer):
         """Create a loadbalancer."""
-        agent = self._schedule_bigiq_agent(context, loadbalancer.id)
+        agent = self._schedule_bigiq_agent(context, loadbalancer)
         super(LoadBalancerManager, self).create(
                 context, loadbalancer, loadbalancer=loadbalancer,
                 host=agent['host'])
@@ -208,12 +381,52 @@ class LoadBalancerManager(EntityManager):
 
     @log_helpers.log_method_call
     def refresh(self, context, loadbalancer):
-        """Refresh a loadbalancer."""
-        pass
+        """Refresh a loadbalancer.
+
+        Sends the whole service of the loadbalancer to its agent, if the
+        agent can resynchronize services. Other agents get the creates and
+        deletes of the entities of the loadbalancer still in PENDING_*
+        again.
+        """
+        agent = self._locate_bigiq_agent(context, loadbalancer.id)
+        if not self.driver.agent_rpc.supports(
+                agent, constants.RPC_API_VERSION_SYNC_SERVICES):
+            statuses = dict(
+                (key, entity.provisioning_status) for key, entity in
+                reconciler.walk_loadbalancer(loadbalancer).items()
+                if entity.provisioning_status in db_api.PENDING_STATUSES)
+            if not statuses:
+                LOG.warning('Agent %s cannot refresh loadbalancer %s',
+                            agent['host'], loadbalancer.id)
+            self.driver.reconciler.resend(context, agent, loadbalancer,
+                                          statuses)
+            return
+        self._flush_members(loadbalancer)
+        self.driver.agent_rpc.sync_services(
+            context, agent['host'],
+            [self.driver.service_builder.service_from_loadbalancer(
+                loadbalancer)],
+            last=True)
 
     @log_helpers.log_method_call
     def stats(self, context, loadbalancer):
-        pass
+        """Request new stats of a loadbalancer if its stats are stale.
+
+        The agent pushes them back through update_loadbalancer_stats,
+        which writes them to the DB. Returns None, so that the plugin
+        returns the stats in the DB without writing them again.
+        """
+        if not self.driver.stats_cache.is_fresh(loadbalancer.id) and \
+                self.driver.stats_cache.start_refresh(loadbalancer.id):
+            try:
+                agent = self._locate_bigiq_agent(context, loadbalancer.id)
+                self.driver.agent_rpc.update_loadbalancer_stats(
+                    context, agent['host'],
+                    serializer.to_api_dict(loadbalancer))
+            except Exception as e:
+                LOG.warning('Failed to request stats of loadbalancer %s: %s',
+                            loadbalancer.id, e)
+        return None
 
 
 class ListenerManager(EntityManager):
@@ -221,6 +434,7 @@ class ListenerManager(EntityManager):
 
     def __init__(self, driver):
         super(ListenerManager, self).__init__(driver)
+        self.entity_type = 'listener'
         self.create_entity_rpc = self.driver.agent_rpc.create_listener
         self.update_entity_rpc = self.driver.agent_rpc.update_listener
         self.delete_entity_rpc = self.driver.agent_rpc.delete_listener
@@ -252,6 +466,7 @@ class PoolManager(EntityManager):
 
     def __init__(self, driver):
         super(PoolManager, self).__init__(driver)
+        self.entity_type = 'pool'
         self.create_entity_rpc = self.driver.agent_rpc.create_pool
         self.update_entity_rpc = self.driver.agent_rpc.update_pool
         self.delete_entity_rpc = self.driver.agent_rpc.delete_pool
@@ -283,10 +498,21 @@ class MemberManager(EntityManager):
 
     def __init__(self, driver):
         super(MemberManager, self).__init__(driver)
+        self.entity_type = 'member'
         self.create_entity_rpc = self.driver.agent_rpc.create_member
         self.update_entity_rpc = self.driver.agent_rpc.update_member
         self.delete_entity_rpc = self.driver.agent_rpc.delete_member
 
+    def _batch_bigiq_agent(self, context, loadbalancer):
+        """Return the agent if member operations can be batched to it."""
+        if not self.driver.member_batcher.enabled:
+            return None
+        agent = self._locate_bigiq_agent(context, loadbalancer.id)
+        if self.driver.agent_rpc.supports(
+                agent, constants.RPC_API_VERSION_BATCH_MEMBERS):
+            return agent
+        return None
+
     @log_helpers.log_method_call
     def create(self, context, member):
         """Create a member."""
@@ -308,11 +534,42 @@ class MemberManager(EntityManager):
         super(MemberManager, self).delete(
             context, member, loadbalancer=loadbalancer)
 
+    def send_create(self, context, member, **kwargs):
+        loadbalancer = kwargs['loadbalancer']
+        agent = self._batch_bigiq_agent(context, loadbalancer)
+        if agent:
+            self.driver.member_batcher.add(
+                context, agent['host'], loadbalancer, 'create', member)
+            return
+        super(MemberManager, self).send_create(context, member, **kwargs)
+
+    def send_update(self, context, old_member, member, **kwargs):
+        loadbalancer = kwargs['loadbalancer']
+        agent = self._batch_bigiq_agent(context, loadbalancer)
+        # Deltas are smaller than batched updates, which carry both members
+        if agent and not self._supports_delta(agent):
+            self.driver.member_batcher.add(
+                context, agent['host'], loadbalancer, 'update', member,
+                old_member=old_member)
+            return
+        super(MemberManager, self).send_update(
+            context, old_member, member, **kwargs)
+
+    def send_delete(self, context, member, **kwargs):
+        loadbalancer = kwargs['loadbalancer']
+        agent = self._batch_bigiq_agent(context, loadbalancer)
+        if agent:
+            self.driver.member_batcher.add(
+                context, agent['host'], loadbalancer, 'delete', member)
+            return
+        super(MemberManager, self).send_delete(context, member, **kwargs)
+
 
 class HealthMonitorManager(EntityManager):
     """HealthMonitorManager class handles Neutron LBaaS monitor CRUD."""
     def __init__(self, driver):
         super(HealthMonitorManager, self).__init__(driver)
+        self.entity_type = 'health_monitor'
         self.create_entity_rpc = self.driver.agent_rpc.create_health_monitor
         self.update_entity_rpc = self.driver.agent_rpc.update_health_monitor
         self.delete_entity_rpc = self.driver.agent_rpc.delete_health_monitor
@@ -345,6 +602,7 @@ class L7PolicyManager(EntityManager):
 
     def __init__(self, driver):
         super(L7PolicyManager, self).__init__(driver)
+        self.entity_type = 'l7policy'
         self.create_entity_rpc = self.driver.agent_rpc.create_l7policy
         self.update_entity_rpc = self.driver.agent_rpc.update_l7policy
         self.delete_entity_rpc = self.driver.agent_rpc.delete_l7policy
@@ -375,6 +633,7 @@ class L7RuleManager(EntityManager):
     """L7RuleManager class handles Neutron LBaaS L7 Rule CRUD."""
     def __init__(self, driver):
         super(L7RuleManager, self).__init__(driver)
+        self.entity_type = 'l7rule'
         self.create_entity_rpc = self.driver.agent_rpc.create_l7rule
         self.update_entity_rpc = self.driver.agent_rpc.update_l7rule
         self.delete_entity_rpc = self.driver.agent_rpc.delete_l7rule
@@ -1,6 +1,17 @@
 from neutron.extensions import agent
+from neutron_lib import exceptions as n_exc
 
 
 class NoEligibleBIGIQAgent(agent.AgentNotFound):
     message = ("No eligible BIG-IQ agent found "
                "for loadbalancer %(loadbalancer_id)s.")
+
+
+class BIGIQAgentRPCQueueFull(n_exc.ServiceUnavailable):
+    message = ("The queue of casts to BIG-IQ agents is full "
+               "(%(size)d casts).")
+
+
+class BIGIQAgentIsNotAlive(n_exc.ServiceUnavailable):
+    message = ("The BIG-IQ agent hosting loadbalancer %(loadbalancer_id)s "
+               "is not alive.")
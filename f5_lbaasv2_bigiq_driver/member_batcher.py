@@ -0,0 +1,124 @@
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from f5_lbaasv2_bigiq_driver import serializer
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.FloatOpt(
+        'f5_bigiq_member_batch_window',
+        default=0,
+        help=('Seconds to collect member operations of a loadbalancer '
+              'before sending them to the BIG-IQ agent in one RPC. The '
+              'plugin rejects API calls on a loadbalancer in PENDING_*, '
+              'so operations only queue up when they do not come from '
+              'the API, and the window otherwise only delays them. 0 '
+              'sends every member operation on its own.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_member_batch_size',
+        default=500,
+        help=('Maximum number of member operations in one batch. A full '
+              'batch is sent without waiting for the window to close.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class _Batch(object):
+
+    def __init__(self, context, host, loadbalancer):
+        self.context = context
+        self.host = host
+        self.loadbalancer = loadbalancer
+        self.members = []
+
+
+class MemberBatcher(object):
+    """Coalesce member operations of a loadbalancer into one RPC.
+
+    Operations are kept in arrival order. The loadbalancer is serialized
+    once when the batch is sent, from the latest loadbalancer added.
+    """
+
+    def __init__(self, agent_rpc):
+        self.agent_rpc = agent_rpc
+        self.window = cfg.CONF.f5_bigiq_member_batch_window
+        self.max_size = cfg.CONF.f5_bigiq_member_batch_size
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, context, host, loadbalancer, operation, member,
+            old_member=None):
+        """Queue a create, update or delete of a member."""
+        operation = {'operation': operation,
+                     'member': serializer.to_api_dict(member)}
+        if old_member is not None:
+            operation['old_member'] = old_member.to_api_dict()
+
+        ready = []
+        with self._lock:
+            batch = self._batches.get(loadbalancer.id)
+            if batch is not None and batch.host != host:
+                # The loadbalancer moved to another agent, so the queued
+                # operations must go to the former one first.
+                ready.append(self._batches.pop(loadbalancer.id))
+                batch = None
+            if batch is None:
+                batch = _Batch(context, host, loadbalancer)
+                self._batches[loadbalancer.id] = batch
+                timer = threading.Timer(self.window, self._expire,
+                                        args=(loadbalancer.id, batch))
+                timer.daemon = True
+                timer.start()
+
+            batch.context = context
+            batch.loadbalancer = loadbalancer
+            batch.members.append(operation)
+            if len(batch.members) >= self.max_size:
+                ready.append(self._batches.pop(loadbalancer.id))
+
+        for batch in ready:
+            self._send(batch)
+
+    def _expire(self, loadbalancer_id, batch):
+        with self._lock:
+            if self._batches.get(loadbalancer_id) is not batch:
+                # Already sent because it was full or the agent changed
+                return
+            del self._batches[loadbalancer_id]
+        self._send(batch)
+
+    def flush(self, loadbalancer_id):
+        """Send the queued operations of a loadbalancer."""
+        with self._lock:
+            batch = self._batches.pop(loadbalancer_id, None)
+        if batch is not None:
+            self._send(batch)
+
+    def flush_all(self):
+        """Send all queued operations, e.g. on shutdown."""
+        with self._lock:
+            batches = list(self._batches.values())
+            self._batches.clear()
+        for batch in batches:
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            self.agent_rpc.batch_members(
+                batch.context, batch.host,
+                serializer.to_api_dict(batch.loadbalancer),
+                batch.members)
+        except Exception as exc:
+            LOG.error('Failed to send %d member operations of loadbalancer '
+                      '%s: %s', len(batch.members), batch.loadbalancer.id,
+                      exc)
@@ -0,0 +1,425 @@
+import abc
+import bisect
+import contextlib
+import functools
+import os
+import random
+import socket
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_service import loopingcall
+import six
+from six.moves import BaseHTTPServer
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.PortOpt(
+        'f5_bigiq_metrics_port',
+        default=0,
+        help=('First TCP port the driver metrics are served on in the '
+              'Prometheus text format, at /metrics. Each API worker serves '
+              'its own metrics on the first free port from this one. 0 '
+              'disables the HTTP exporter.')
+    ),
+    cfg.StrOpt(
+        'f5_bigiq_metrics_bind_host',
+        default='127.0.0.1',
+        help=('Address the metrics HTTP exporter listens on.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_metrics_port_range',
+        default=64,
+        help=('Number of ports from f5_bigiq_metrics_port tried by the '
+              'metrics HTTP exporter.')
+    ),
+    cfg.StrOpt(
+        'f5_bigiq_metrics_file',
+        default=None,
+        help=('File the driver metrics are written to in the Prometheus '
+              'text format, e.g. for the node exporter textfile collector. '
+              '%(pid)s is replaced with the process id of the API worker.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_metrics_file_interval',
+        default=15,
+        help=('Seconds between writes of the metrics file.')
+    ),
+    cfg.FloatOpt(
+        'f5_bigiq_metrics_payload_sample_rate',
+        default=0.01,
+        min=0,
+        max=1,
+        help=('Fraction of the casts to the BIG-IQ agents whose arguments '
+              'are JSON encoded to observe their size. 0 leaves '
+              'f5_bigiq_rpc_payload_bytes empty.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+# Latency buckets in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0, 30.0)
+# Payload size buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class _Metric(object):
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        # Label sets whose value is read from a function when rendered
+        self._functions = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s takes the labels %s' % (
+                self.name, ', '.join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type_name)]
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+        for key, func in functions:
+            values[key] = func()
+        lines.extend(self._render_samples(sorted(values.items())))
+        return lines
+
+    @abc.abstractmethod
+    def _render_samples(self, items):
+        """Return the sample lines of the values of each label set."""
+
+
+class _ValueMetric(_Metric):
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, func, **labels):
+        """Read the value of a set of label values from func().
+
+        For the counts kept by another object, which are read when the
+        metric is rendered rather than copied on every change.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = func
+
+    def value(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            func = self._functions.get(key)
+            if func is None:
+                return self._values.get(key, 0)
+        return func()
+
+    def _render_samples(self, items):
+        return ['%s%s %s' % (self.name,
+                             _format_labels(self.labelnames, key),
+                             _format_value(value))
+                for key, value in items]
+
+
+class Counter(_ValueMetric):
+    """A count which only goes up, per set of label values."""
+
+    type_name = 'counter'
+
+
+class Gauge(_ValueMetric):
+    """A value which goes up and down, per set of label values."""
+
+    type_name = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in a with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            bounds = self.buckets + (float('inf'),)
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.labelnames, key,
+                                   [('le', _format_value(float(bound)))]),
+                    cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """Metrics of one process, by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError('Metric %s is already a %s' % (
+                    name, metric.type_name))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=TIME_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames,
+                              buckets=buckets)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                             key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RPC_CASTS = REGISTRY.counter(
+    'f5_bigiq_rpc_casts_total',
+    'Casts sent to the BIG-IQ agents.', ('method',))
+RPC_CAST_ERRORS = REGISTRY.counter(
+    'f5_bigiq_rpc_cast_errors_total',
+    'Casts to the BIG-IQ agents which failed to be sent.', ('method',))
+RPC_CAST_SECONDS = REGISTRY.histogram(
+    'f5_bigiq_rpc_cast_seconds',
+    'Time to hand a cast to the message broker.', ('method',))
+RPC_PAYLOAD_BYTES = REGISTRY.histogram(
+    'f5_bigiq_rpc_payload_bytes',
+    'Size of the JSON encoded arguments of a sample of the casts, '
+    'see f5_bigiq_metrics_payload_sample_rate.', ('method',),
+    buckets=SIZE_BUCKETS)
+CALLBACKS = REGISTRY.counter(
+    'f5_bigiq_callbacks_total',
+    'Calls from the BIG-IQ agents, by method and outcome.',
+    ('method', 'outcome'))
+CALLBACK_SECONDS = REGISTRY.histogram(
+    'f5_bigiq_callback_seconds',
+    'Time spent handling calls from the BIG-IQ agents, mostly in the DB.',
+    ('method',))
+SCHEDULER_DECISIONS = REGISTRY.counter(
+    'f5_bigiq_scheduler_decisions_total',
+    'Loadbalancers scheduled, by scheduler and agent.',
+    ('scheduler', 'agent'))
+SCHEDULER_FAILURES = REGISTRY.counter(
+    'f5_bigiq_scheduler_failures_total',
+    'Loadbalancers which no agent could be scheduled for.',
+    ('scheduler',))
+
+
+def sample_payload():
+    """Whether to observe the payload size of the cast being sent."""
+    rate = cfg.CONF.f5_bigiq_metrics_payload_sample_rate
+    return rate > 0 and random.random() < rate
+
+
+# Whether the callback running in each thread failed
+_callback = threading.local()
+
+
+def callback_failed():
+    """Count the running callback as an error though it did not raise.
+
+    For the callbacks which log their errors instead of raising them.
+    """
+    _callback.failed = True
+
+
+def callback(func):
+    """Count and time an RPC endpoint method called by the agents."""
+    method = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        outer_failed = getattr(_callback, 'failed', False)
+        _callback.failed = False
+        outcome = 'error'
+        try:
+            result = func(*args, **kwargs)
+            if not _callback.failed:
+                outcome = 'success'
+            return result
+        finally:
+            _callback.failed = outer_failed
+            CALLBACK_SECONDS.observe(time.time() - start, method=method)
+            CALLBACKS.inc(method=method, outcome=outcome)
+    return wrapper
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('Metrics request from %s: %s', self.client_address[0],
+                  format % args)
+
+
+class MetricsExporter(object):
+    """Export a registry over HTTP and/or to a file.
+
+    Started after the fork of the API workers, each of which exports its
+    own metrics.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self._server = None
+        self._loop = None
+
+    def start(self):
+        port = cfg.CONF.f5_bigiq_metrics_port
+        if port and self._server is None:
+            self._server = self._serve(port)
+        path = cfg.CONF.f5_bigiq_metrics_file
+        interval = cfg.CONF.f5_bigiq_metrics_file_interval
+        if path and interval > 0 and self._loop is None:
+            self._loop = loopingcall.FixedIntervalLoopingCall(self.write)
+            self._loop.start(interval=interval)
+
+    def _serve(self, port):
+        handler = type('MetricsHandler', (_MetricsHandler,),
+                       {'registry': self.registry})
+        host = cfg.CONF.f5_bigiq_metrics_bind_host
+        for candidate in range(port, port + max(
+                cfg.CONF.f5_bigiq_metrics_port_range, 1)):
+            try:
+                server = BaseHTTPServer.HTTPServer((host, candidate), handler)
+            except socket.error:
+                continue
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            LOG.info('Serving driver metrics on %s:%d', host, candidate)
+            return server
+        LOG.error('No free port to serve driver metrics on from %s:%d',
+                  host, port)
+        return None
+
+    def write(self):
+        """Write the metrics file, replacing it atomically."""
+        path = cfg.CONF.f5_bigiq_metrics_file
+        if not path:
+            return
+        path = path % {'pid': os.getpid()}
+        temporary = '%s.tmp' % path
+        try:
+            with open(temporary, 'w') as f:
+                f.write(self.registry.render())
+            os.rename(temporary, path)
+        except (IOError, OSError) as e:
+            LOG.error('Failed to write metrics to %s: %s', path, e)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+            self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
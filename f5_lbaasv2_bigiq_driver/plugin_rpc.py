@@ -1,18 +1,44 @@
+import collections
+import threading
+
 from neutron.common import rpc as neutron_rpc
 from neutron.db import agents_db
 from neutron.db.models import agent as agents_model
 from neutron_lib import constants as plugin_constants
+from neutron_lib import context as neutron_context
+from neutron_lib import exceptions as n_exc
+from neutron_lib.plugins import directory
 
-from neutron_lbaas.db.loadbalancer import models
-
+from oslo_config import cfg
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
+from oslo_utils import uuidutils
 
 from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api
+from f5_lbaasv2_bigiq_driver import metrics
+from f5_lbaasv2_bigiq_driver import tracing
 
 
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_sync_page_size',
+        default=100,
+        help=('Maximum number of loadbalancers returned in one page to a '
+              'BIG-IQ agent resynchronizing its loadbalancers.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_sync_chunk_size',
+        default=20,
+        help=('Number of loadbalancer services in each sync_services cast '
+              'streamed to a BIG-IQ agent.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
 
 class LBaaSv2PluginCallbacksRPC(object):
     """Agent to plugin RPC API."""
@@ -21,6 +47,9 @@ class LBaaSv2PluginCallbacksRPC(object):
         """LBaaSv2PluginCallbacksRPC constructor."""
         self.driver = driver
         self.cluster_wide_agents = {}
+        # Sync id of the service stream running to each agent host
+        self._syncs = {}
+        self._syncs_lock = threading.Lock()
 
     def create_rpc_listener(self):
         topic = constants.TOPIC_LBAASV2_BIGIQ_DRIVER
@@ -35,10 +64,12 @@ class LBaaSv2PluginCallbacksRPC(object):
 
     # change the admin_state_up of the an agent
     @log_helpers.log_method_call
+    @metrics.callback
     def set_agent_admin_state(self, context, admin_state_up, host=None):
         """Set the admin_up_state of an agent."""
         if not host:
             LOG.error('tried to set agent admin_state_up without host')
+            metrics.callback_failed()
             return False
         with context.session.begin(subtransactions=True):
             query = context.session.query(agents_model.Agent)
@@ -54,228 +85,387 @@ class LBaaSv2PluginCallbacksRPC(object):
             except Exception as exc:
                 # Impossible to return multiple agents with same host
                 LOG.error('query for agent produced: %s' % str(exc))
+                metrics.callback_failed()
                 return False
+        # Cached bindings carry the agent state, drop those of this agent
+        self.driver.binding_cache.pop_if(
+            lambda loadbalancer_id, agent: agent['host'] == host)
         return True
 
+    def _page_limit(self, limit):
+        page_size = cfg.CONF.f5_bigiq_sync_page_size
+        return min(limit, page_size) if limit else page_size
+
     @log_helpers.log_method_call
+    @metrics.callback
+    def get_all_loadbalancers(self, context, host=None, marker=None,
+                              limit=None):
+        """Return a page of the loadbalancers bound to an agent.
+
+        The next page starts after next_marker, which is None on the last
+        page.
+        """
+        limit = self._page_limit(limit)
+        builder = self.driver.service_builder
+        loadbalancer_ids = builder.get_loadbalancer_ids(
+            context, host, marker=marker, limit=limit)
+        next_marker = None
+        if len(loadbalancer_ids) == limit:
+            next_marker = loadbalancer_ids[-1]
+        return {'loadbalancers': builder.get_loadbalancers(
+                    context, loadbalancer_ids),
+                'next_marker': next_marker}
+
+    @log_helpers.log_method_call
+    @metrics.callback
+    def get_service_by_loadbalancer_id(self, context, loadbalancer_id=None):
+        """Return the service tree of a loadbalancer."""
+        return self.driver.service_builder.build(context, loadbalancer_id)
+
+    @log_helpers.log_method_call
+    @metrics.callback
+    def get_services_by_host(self, context, host=None, marker=None,
+                             limit=None):
+        """Return a page of the service trees bound to an agent."""
+        limit = self._page_limit(limit)
+        builder = self.driver.service_builder
+        loadbalancer_ids = builder.get_loadbalancer_ids(
+            context, host, marker=marker, limit=limit)
+        next_marker = None
+        if len(loadbalancer_ids) == limit:
+            next_marker = loadbalancer_ids[-1]
+        return {'services': builder.build_many(context, loadbalancer_ids),
+                'next_marker': next_marker}
+
+    @log_helpers.log_method_call
+    @metrics.callback
+    def sync_services(self, context, host=None, chunk_size=None):
+        """Stream the service trees bound to an agent back to it.
+
+        The services are cast to the agent in sync_services messages of
+        chunk_size services, from a background thread. Returns the sync id
+        carried by those messages, the last of which has last=True. While
+        the services of a host are streamed, further calls for the host
+        return the sync id of that stream instead of starting another one.
+        """
+        if not host:
+            LOG.error('tried to sync services without host')
+            metrics.callback_failed()
+            return None
+        chunk_size = chunk_size or cfg.CONF.f5_bigiq_sync_chunk_size
+        with self._syncs_lock:
+            sync_id = self._syncs.get(host)
+            if sync_id is not None:
+                LOG.debug('Services of agent %s are already being synced '
+                          'by %s', host, sync_id)
+                return sync_id
+            sync_id = uuidutils.generate_uuid()
+            self._syncs[host] = sync_id
+        thread = threading.Thread(target=self._stream_services,
+                                  args=(host, sync_id, chunk_size))
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            with self._syncs_lock:
+                del self._syncs[host]
+            raise
+        return sync_id
+
+    def _stream_services(self, host, sync_id, chunk_size):
+        try:
+            self._send_services(host, sync_id, chunk_size)
+        finally:
+            with self._syncs_lock:
+                del self._syncs[host]
+
+    def _send_services(self, host, sync_id, chunk_size):
+        context = neutron_context.get_admin_context()
+        builder = self.driver.service_builder
+        marker = None
+        sequence = 0
+        try:
+            while True:
+                loadbalancer_ids = builder.get_loadbalancer_ids(
+                    context, host, marker=marker, limit=chunk_size)
+                last = len(loadbalancer_ids) < chunk_size
+                self.driver.agent_rpc.sync_services(
+                    context, host, sync_id=sync_id, sequence=sequence,
+                    services=builder.build_many(context, loadbalancer_ids),
+                    last=last)
+                if last:
+                    break
+                marker = loadbalancer_ids[-1]
+                sequence += 1
+        except Exception as e:
+            LOG.error('Failed to sync services %s to agent %s: %s',
+                      sync_id, host, e)
+        else:
+            LOG.debug('Synced services %s to agent %s in %d messages',
+                      sync_id, host, sequence + 1)
+
+    @log_helpers.log_method_call
+    @metrics.callback
     def update_loadbalancer_stats(
             self, context, loadbalancer_id=None, stats=None):
         """Update service stats."""
-        with context.session.begin(subtransactions=True):
-            try:
-                self.driver.plugin.db.update_loadbalancer_stats(
-                    context, loadbalancer_id, stats
-                )
-            except Exception as e:
-                LOG.error('Exception: update_loadbalancer_stats: %s',
-                          e.message)
+        self.driver.stats_cache.update(loadbalancer_id)
+        self.driver.stats_writer.add(loadbalancer_id, stats)
 
     @log_helpers.log_method_call
+    @metrics.callback
+    def update_statuses(self, context, statuses=None):
+        """Agent confirmation hook to update many statuses at once.
+
+        statuses is a list of (resource_type, id, provisioning_status,
+        operating_status). When a resource is listed more than once, the
+        last entry wins.
+        """
+        latest = collections.OrderedDict()
+        for resource_type, resource_id, provisioning_status, \
+                operating_status in statuses or []:
+            if resource_type not in db_api.STATUS_MODELS:
+                LOG.error('update_statuses: unknown resource type %s',
+                          resource_type)
+                metrics.callback_failed()
+                continue
+            latest[(resource_type, resource_id)] = (provisioning_status,
+                                                    operating_status)
+        status_table = self.driver.status_table
+        for (resource_type, resource_id), status in list(latest.items()):
+            if not status_table.accept(resource_type, resource_id, *status):
+                del latest[(resource_type, resource_id)]
+
+        groups = collections.OrderedDict()
+        for (resource_type, resource_id), status in latest.items():
+            groups.setdefault((resource_type,) + status, []).append(
+                resource_id)
+
+        try:
+            with context.session.begin(subtransactions=True):
+                for (resource_type, provisioning_status,
+                     operating_status), ids in groups.items():
+                    db_api.update_statuses(
+                        context.session, resource_type, ids,
+                        provisioning_status, operating_status)
+        except Exception as e:
+            LOG.error('Exception: update_statuses: %s', e)
+            metrics.callback_failed()
+            return
+        for (resource_type, resource_id), status in latest.items():
+            status_table.record(resource_type, resource_id, *status)
+        self.driver.tracer.finish_many(
+            (resource_type, resource_id, status[0])
+            for (resource_type, resource_id), status in latest.items())
+
+    def _update_status(self, context, resource_type, resource_id,
+                       provisioning_status, operating_status, trace,
+                       sequence, epoch):
+        """Write the status reported for a resource with one UPDATE.
+
+        The UPDATE is conditional on the provisioning status, following the
+        PENDING_DELETE rules of db_api.STATUS_MODELS, so that no row is
+        read and locked first. Returns whether a row was updated.
+        """
+        status_table = self.driver.status_table
+        if not status_table.accept(resource_type, resource_id,
+                                   provisioning_status, operating_status,
+                                   sequence, epoch):
+            return False
+        self.driver.tracer.finish(resource_type, resource_id,
+                                  provisioning_status, trace)
+        try:
+            with context.session.begin(subtransactions=True):
+                updated = db_api.update_statuses(
+                    context.session, resource_type, [resource_id],
+                    provisioning_status, operating_status)
+        except Exception as e:
+            LOG.error('Exception: update_%s_status: %s', resource_type, e)
+            metrics.callback_failed()
+            return False
+        status_table.record(resource_type, resource_id, provisioning_status,
+                            operating_status, sequence, epoch)
+        if not updated:
+            LOG.debug('Status of %s %s not updated, it is gone or being '
+                      'deleted', resource_type, resource_id)
+        return bool(updated)
+
+    @log_helpers.log_method_call
+    @metrics.callback
     def update_loadbalancer_status(self, context, loadbalancer_id=None,
-                                   status=None, operating_status=None):
+                                   status=None, operating_status=None,
+                                   trace=None, sequence=None, epoch=None):
         """Agent confirmation hook to update loadbalancer status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                lb_db = self.driver.plugin.db.get_loadbalancer(
-                    context,
-                    loadbalancer_id
-                )
-                if (lb_db.provisioning_status ==
-                        plugin_constants.PENDING_DELETE):
-                    status = plugin_constants.PENDING_DELETE
-
-                self.driver.plugin.db.update_status(
-                    context,
-                    models.LoadBalancer,
-                    loadbalancer_id,
-                    status,
-                    operating_status
-                )
-            except Exception as e:
-                LOG.error('Exception: update_loadbalancer_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'loadbalancer', loadbalancer_id, status, operating_status,
+            trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def loadbalancer_destroyed(self, context, loadbalancer_id=None):
         """Agent confirmation hook that loadbalancer has been destroyed."""
         self.driver.plugin.db.delete_loadbalancer(context, loadbalancer_id)
+        self.driver.tracer.finish('loadbalancer', loadbalancer_id,
+                                  tracing.DELETED)
+        self.driver.status_table.pop('loadbalancer', loadbalancer_id)
+        self.driver.binding_cache.pop(loadbalancer_id)
+        self.driver.stats_cache.pop(loadbalancer_id)
+
+    def _delete_vip_ports(self, context, vip_port_ids):
+        # Outside of the transaction deleting the loadbalancers, like
+        # plugin.db.delete_loadbalancer does.
+        core_plugin = directory.get_plugin()
+        for vip_port_id in vip_port_ids:
+            try:
+                core_plugin.delete_port(context, vip_port_id)
+            except n_exc.PortNotFound:
+                pass
+
+    @log_helpers.log_method_call
+    @metrics.callback
+    def resources_destroyed(self, context, resources=None):
+        """Agent confirmation hook that many resources are destroyed.
+
+        resources maps resource types to lists of ids. They are deleted,
+        children first, in one transaction. Returns the number of rows
+        deleted per resource type.
+        """
+        resources = dict(resources or {})
+        for resource_type in list(resources):
+            if resource_type not in db_api.DELETE_ORDER:
+                LOG.error('resources_destroyed: unknown resource type %s',
+                          resource_type)
+                metrics.callback_failed()
+                del resources[resource_type]
+        with context.session.begin(subtransactions=True):
+            deleted, vip_port_ids = db_api.delete_resources(
+                context.session, resources)
+        self._delete_vip_ports(context, vip_port_ids)
+        for loadbalancer_id in resources.get('loadbalancer', []):
+            self.driver.binding_cache.pop(loadbalancer_id)
+            self.driver.stats_cache.pop(loadbalancer_id)
+        self.driver.tracer.finish_many(
+            (resource_type, resource_id, tracing.DELETED)
+            for resource_type, ids in resources.items()
+            for resource_id in ids)
+        for resource_type, ids in resources.items():
+            for resource_id in ids:
+                self.driver.status_table.pop(resource_type, resource_id)
+        LOG.debug('Destroyed resources: %s', deleted)
+        return deleted
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_listener_status(self, context, listener_id=None,
                                provisioning_status=plugin_constants.ERROR,
-                               operating_status=None):
+                               operating_status=None, trace=None,
+                               sequence=None, epoch=None):
         """Agent confirmation hook to update listener status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                listener_db = self.driver.plugin.db.get_listener(
-                    context,
-                    listener_id
-                )
-                if (listener_db.provisioning_status ==
-                        plugin_constants.PENDING_DELETE):
-                    provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
-                    context,
-                    models.Listener,
-                    listener_id,
-                    provisioning_status,
-                    operating_status
-                )
-            except Exception as e:
-                LOG.error('Exception: update_listener_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'listener', listener_id, provisioning_status,
+            operating_status, trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def listener_destroyed(self, context, listener_id=None):
         """Agent confirmation hook that listener has been destroyed."""
         self.driver.plugin.db.delete_listener(context, listener_id)
-        # TODO: remove lb agent bindings
+        self.driver.tracer.finish('listener', listener_id, tracing.DELETED)
+        self.driver.status_table.pop('listener', listener_id)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_pool_status(self, context, pool_id=None,
                            provisioning_status=plugin_constants.ERROR,
-                           operating_status=None):
+                           operating_status=None, trace=None,
+                           sequence=None, epoch=None):
         """Agent confirmations hook to update pool status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                pool = self.driver.plugin.db.get_pool(
-                    context,
-                    pool_id
-                )
-                if (pool.provisioning_status !=
-                        plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
-                        context,
-                        models.PoolV2,
-                        pool_id,
-                        provisioning_status,
-                        operating_status
-                    )
-            except Exception as e:
-                LOG.error('Exception: update_pool_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'pool', pool_id, provisioning_status, operating_status,
+            trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def pool_destroyed(self, context, pool_id=None):
         """Agent confirmation hook that pool has been destroyed."""
         self.driver.plugin.db.delete_pool(context, pool_id)
+        self.driver.tracer.finish('pool', pool_id, tracing.DELETED)
+        self.driver.status_table.pop('pool', pool_id)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_member_status(self, context, member_id=None,
                              provisioning_status=None,
-                             operating_status=None):
+                             operating_status=None, trace=None,
+                             sequence=None, epoch=None):
         """Agent confirmations hook to update member status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                member = self.driver.plugin.db.get_pool_member(
-                    context,
-                    member_id
-                )
-                if (member.provisioning_status !=
-                        plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
-                        context,
-                        models.MemberV2,
-                        member_id,
-                        provisioning_status,
-                        operating_status
-                    )
-            except Exception as e:
-                LOG.error('Exception: update_member_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'member', member_id, provisioning_status,
+            operating_status, trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def member_destroyed(self, context, member_id=None):
         """Agent confirmation hook that member has been destroyed."""
         self.driver.plugin.db.delete_member(context, member_id)
+        self.driver.tracer.finish('member', member_id, tracing.DELETED)
+        self.driver.status_table.pop('member', member_id)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_health_monitor_status(
             self, context, health_monitor_id,
-            provisioning_status=plugin_constants.ERROR, operating_status=None):
+            provisioning_status=plugin_constants.ERROR, operating_status=None,
+            trace=None, sequence=None, epoch=None):
         """Agent confirmation hook to update health monitor status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                health_monitor = self.driver.plugin.db.get_healthmonitor(
-                    context,
-                    health_monitor_id
-                )
-                if (health_monitor.provisioning_status !=
-                        plugin_constants.PENDING_DELETE):
-                    self.driver.plugin.db.update_status(
-                        context,
-                        models.HealthMonitorV2,
-                        health_monitor_id,
-                        provisioning_status,
-                        operating_status
-                    )
-            except Exception as e:
-                LOG.error('Exception: update_health_monitor_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'health_monitor', health_monitor_id, provisioning_status,
+            operating_status, trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def health_monitor_destroyed(self, context, health_monitor_id=None):
         """Agent confirmation hook that health_monitor has been destroyed."""
         self.driver.plugin.db.delete_healthmonitor(context, health_monitor_id)
+        self.driver.tracer.finish('health_monitor', health_monitor_id,
+                                  tracing.DELETED)
+        self.driver.status_table.pop('health_monitor', health_monitor_id)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_l7policy_status(self, context, l7policy_id=None,
                                provisioning_status=plugin_constants.ERROR,
-                               operating_status=None):
+                               operating_status=None, trace=None,
+                               sequence=None, epoch=None):
         """Agent confirmation hook to update l7 policy status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                l7policy_db = self.driver.plugin.db.get_l7policy(
-                    context,
-                    l7policy_id
-                )
-                if (l7policy_db.provisioning_status ==
-                        plugin_constants.PENDING_DELETE):
-                    provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
-                    context,
-                    models.L7Policy,
-                    l7policy_id,
-                    provisioning_status,
-                    operating_status
-                )
-            except Exception as e:
-                LOG.error('Exception: update_l7policy_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'l7policy', l7policy_id, provisioning_status,
+            operating_status, trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def l7policy_destroyed(self, context, l7policy_id=None):
         LOG.debug("l7policy_destroyed")
         """Agent confirmation hook that l7 policy has been destroyed."""
         self.driver.plugin.db.delete_l7policy(context, l7policy_id)
+        self.driver.tracer.finish('l7policy', l7policy_id, tracing.DELETED)
+        self.driver.status_table.pop('l7policy', l7policy_id)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def update_l7rule_status(self, context, l7rule_id=None, l7policy_id=None,
                              provisioning_status=plugin_constants.ERROR,
-                             operating_status=None):
+                             operating_status=None, trace=None,
+                             sequence=None, epoch=None):
         """Agent confirmation hook to update l7 policy status."""
-        with context.session.begin(subtransactions=True):
-            try:
-                l7rule_db = self.driver.plugin.db.get_l7policy_rule(
-                    context,
-                    l7rule_id,
-                    l7policy_id
-                )
-                if (l7rule_db.provisioning_status ==
-                        plugin_constants.PENDING_DELETE):
-                    provisioning_status = plugin_constants.PENDING_DELETE
-                self.driver.plugin.db.update_status(
-                    context,
-                    models.L7Rule,
-                    l7rule_id,
-                    provisioning_status,
-                    operating_status
-                )
-            except Exception as e:
-                LOG.error('Exception: update_l7rule_status: %s',
-                          e.message)
+        return self._update_status(
+            context, 'l7rule', l7rule_id, provisioning_status,
+            operating_status, trace, sequence, epoch)
 
     @log_helpers.log_method_call
+    @metrics.callback
     def l7rule_destroyed(self, context, l7rule_id):
         """Agent confirmation hook that l7 policy has been destroyed."""
         self.driver.plugin.db.delete_l7policy_rule(context, l7rule_id)
+        self.driver.tracer.finish('l7rule', l7rule_id, tracing.DELETED)
+        self.driver.status_table.pop('l7rule', l7rule_id)
@@ -0,0 +1,408 @@
+import collections
+import threading
+import time
+
+from neutron.db.models import agent as agents_db
+from neutron_lib import constants as plugin_constants
+from neutron_lib import context as neutron_context
+from neutron_lib import worker
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+from neutron_lbaas import agent_scheduler
+
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api
+from f5_lbaasv2_bigiq_driver import metrics
+from f5_lbaasv2_bigiq_driver import serializer
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_reconcile_interval',
+        default=300,
+        help=('Seconds between scans for entities stuck in a PENDING_* '
+              'provisioning status, whose operation is sent again to '
+              'their BIG-IQ agent. 0 disables the reconciliation.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_reconcile_threshold',
+        default=600,
+        help=('Seconds an entity must stay in the same PENDING_* '
+              'provisioning status, or since its operation was last sent '
+              'again, before it is sent again.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_reconcile_max_attempts',
+        default=3,
+        help=('Number of times the operation of a stuck entity is sent '
+              'again before it is left to the operator. 0 retries '
+              'forever.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_reconcile_batch_size',
+        default=20,
+        help=('Number of loadbalancers of one BIG-IQ agent reconciled in '
+              'each batch, and services in each sync_services cast.')
+    ),
+    cfg.FloatOpt(
+        'f5_bigiq_reconcile_rate',
+        default=1.0,
+        help=('Maximum number of reconciliation batches sent per second. '
+              '0 sends them without pause.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+RESENDS = metrics.REGISTRY.counter(
+    'f5_bigiq_reconcile_resends_total',
+    'Operations of stuck entities sent again to the BIG-IQ agents.',
+    ('entity_type', 'operation'))
+
+# Entity types in the order their creates and updates are sent, parents
+# first. Deletes are sent in the reverse order.
+CREATE_ORDER = tuple(reversed(db_api.DELETE_ORDER))
+
+
+def walk_loadbalancer(loadbalancer):
+    """Return {(entity_type, id): entity} of a loadbalancer data model."""
+    entities = {('loadbalancer', loadbalancer.id): loadbalancer}
+    for listener in loadbalancer.listeners:
+        entities[('listener', listener.id)] = listener
+        for l7policy in listener.l7_policies:
+            entities[('l7policy', l7policy.id)] = l7policy
+            for l7rule in l7policy.rules:
+                entities[('l7rule', l7rule.id)] = l7rule
+    for pool in loadbalancer.pools:
+        entities[('pool', pool.id)] = pool
+        for member in pool.members:
+            entities[('member', member.id)] = member
+        if pool.healthmonitor:
+            entities[('health_monitor', pool.healthmonitor.id)] = \
+                pool.healthmonitor
+    return entities
+
+
+class _Pending(object):
+
+    def __init__(self, status, since):
+        self.status = status
+        # When the entity got its status, or its operation was last sent
+        self.since = since
+        self.attempts = 0
+
+
+class Reconciler(object):
+    """Send again the operations of entities stuck in PENDING_*.
+
+    An operation cast to an agent which dropped it leaves its entity in a
+    PENDING_* provisioning status for good. Each run scans the DB for such
+    entities, and those which kept the same status for longer than the
+    threshold are grouped by the agent of their loadbalancer. Each agent
+    then gets, in rate-limited batches of loadbalancers:
+
+    - the services of the loadbalancers with creates or updates pending, in
+      sync_services casts, or the create of each pending entity, parents
+      first, if the agent cannot resynchronize services,
+    - the delete of each entity pending delete, children first.
+
+    The old entity of an update is lost, so updates are only sent again in
+    services. A loadbalancer in PENDING_UPDATE with stuck children is only
+    waiting for them, and is not sent again itself.
+
+    The time an entity entered its status is only known from the scans, so
+    entities are sent again at the earliest one threshold after the first
+    scan which found them. The reconciler runs in a single process, in a
+    ReconcilerWorker. Loadbalancers of dead agents are left to the agent
+    monitor.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.interval = cfg.CONF.f5_bigiq_reconcile_interval
+        self.threshold = cfg.CONF.f5_bigiq_reconcile_threshold
+        self.max_attempts = cfg.CONF.f5_bigiq_reconcile_max_attempts
+        self.batch_size = max(cfg.CONF.f5_bigiq_reconcile_batch_size, 1)
+        self.rate = cfg.CONF.f5_bigiq_reconcile_rate
+        self._loop = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._pending = {}
+        self.runs = 0
+        self.resent = 0
+        self.progress = {}
+
+    def start(self):
+        if self.interval > 0 and self._loop is None:
+            self._stopping = False
+            self._loop = loopingcall.FixedIntervalLoopingCall(self.check)
+            self._loop.start(interval=self.interval,
+                             initial_delay=self.interval)
+
+    def stop(self):
+        self._stopping = True
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.progress)
+            stats.update({'runs': self.runs,
+                          'resent': self.resent,
+                          'tracked': len(self._pending)})
+        return stats
+
+    def _report(self, **progress):
+        with self._lock:
+            self.progress.update(progress)
+
+    def check(self):
+        context = neutron_context.get_admin_context()
+        try:
+            self.reconcile(context)
+        except Exception as e:
+            LOG.error('Failed to reconcile stuck entities: %s', e)
+            self._report(running=False, finished_at=time.time(),
+                         error=str(e))
+
+    def find_stuck(self, context):
+        """Return the entities to send again and counts of the others.
+
+        Returns {loadbalancer_id: {(entity_type, id): status}}, the number
+        of entities in PENDING_* and the number of those given up on after
+        the maximum number of attempts.
+        """
+        now = time.time()
+        tracked = {}
+        stuck = collections.defaultdict(dict)
+        abandoned = 0
+        resources = db_api.get_pending_resources(context.session)
+        for resource_type, resource_id, loadbalancer_id, status in \
+                resources:
+            key = (resource_type, resource_id)
+            pending = self._pending.get(key)
+            if pending is None or pending.status != status:
+                pending = _Pending(status, now)
+            tracked[key] = pending
+            if now - pending.since < self.threshold:
+                continue
+            if self.max_attempts and pending.attempts >= self.max_attempts:
+                # Logged once, the attempts then go past the maximum
+                if pending.attempts == self.max_attempts:
+                    LOG.error('%s %s is still %s after %d attempts to send '
+                              'its operation again, giving up',
+                              resource_type, resource_id, status,
+                              pending.attempts)
+                    pending.attempts += 1
+                abandoned += 1
+                continue
+            stuck[loadbalancer_id][key] = status
+        for loadbalancer_id, statuses in stuck.items():
+            # The loadbalancer of a stuck child is PENDING_UPDATE until the
+            # agent reports on the child
+            key = ('loadbalancer', loadbalancer_id)
+            if len(statuses) > 1 and \
+                    statuses.get(key) == plugin_constants.PENDING_UPDATE:
+                del statuses[key]
+        with self._lock:
+            self._pending = tracked
+        return stuck, len(resources), abandoned
+
+    def _get_agents(self, context, loadbalancer_ids):
+        # Returns a dict of loadbalancer id to the agent it is bound to
+        binding = agent_scheduler.LoadbalancerAgentBinding
+        agents = {}
+        for chunk in db_api.chunks(loadbalancer_ids):
+            query = context.session.query(binding.loadbalancer_id,
+                                          agents_db.Agent)
+            query = query.join(agents_db.Agent,
+                               agents_db.Agent.id == binding.agent_id)
+            query = query.filter(binding.loadbalancer_id.in_(chunk))
+            agents.update((row[0], row[1]) for row in query)
+        return agents
+
+    def reconcile(self, context):
+        """Send again the operations of the stuck entities.
+
+        Returns the number of entities whose operation was sent again.
+        """
+        self._report(running=True, started_at=time.time(), finished_at=None,
+                     error=None)
+        stuck, pending, abandoned = self.find_stuck(context)
+        agents = self._get_agents(context, list(stuck))
+
+        by_host = collections.defaultdict(list)
+        skipped = 0
+        for loadbalancer_id in sorted(stuck):
+            agent = agents.get(loadbalancer_id)
+            if agent is None or not agent.is_active or \
+                    not agent.admin_state_up:
+                skipped += 1
+                continue
+            by_host[agent.host].append(loadbalancer_id)
+
+        batches = [(host, loadbalancer_ids[start:start + self.batch_size])
+                   for host, loadbalancer_ids in sorted(by_host.items())
+                   for start in range(0, len(loadbalancer_ids),
+                                      self.batch_size)]
+        hosts = dict((agent.host, agent) for agent in agents.values())
+        stuck_count = sum(len(entities) for entities in stuck.values())
+        self._report(pending=pending, abandoned=abandoned, skipped=skipped,
+                     stuck=stuck_count, loadbalancers=len(stuck),
+                     batches=len(batches), batches_done=0, failed=0,
+                     resent_last_run=0)
+        if stuck:
+            LOG.warning('Found %d entities of %d loadbalancers stuck in '
+                        'PENDING_*, sending their operations again in %d '
+                        'batches', stuck_count, len(stuck), len(batches))
+
+        resent = 0
+        failed = 0
+        for index, (host, loadbalancer_ids) in enumerate(batches):
+            if self._stopping:
+                break
+            if index and self.rate > 0:
+                time.sleep(1.0 / self.rate)
+            try:
+                count = self._send_batch(context, hosts[host],
+                                         loadbalancer_ids, stuck)
+            except Exception as e:
+                LOG.error('Failed to reconcile loadbalancers %s of agent '
+                          '%s: %s', ', '.join(loadbalancer_ids), host, e)
+                failed += len(loadbalancer_ids)
+                count = 0
+            else:
+                LOG.info('Reconciled batch %d/%d: %d entities of %d '
+                         'loadbalancers sent again to agent %s', index + 1,
+                         len(batches), count, len(loadbalancer_ids), host)
+            resent += count
+            with self._lock:
+                self.resent += count
+                self.progress.update(batches_done=index + 1, failed=failed,
+                                     resent_last_run=resent)
+
+        with self._lock:
+            self.runs += 1
+            self.progress.update(running=False, finished_at=time.time())
+        return resent
+
+    def _send_batch(self, context, agent, loadbalancer_ids, stuck):
+        now = time.time()
+        self.driver.agent_rpc.register_agent(agent)
+        builder = self.driver.service_builder
+        sync = self.driver.agent_rpc.supports(
+            agent, constants.RPC_API_VERSION_SYNC_SERVICES)
+
+        services = []
+        resends = []
+        sent = []
+        for loadbalancer in builder.get_loadbalancer_models(
+                context, loadbalancer_ids):
+            statuses = stuck[loadbalancer.id]
+            deletes = dict((key, status) for key, status in statuses.items()
+                           if status == plugin_constants.PENDING_DELETE)
+            if sync and len(deletes) < len(statuses) and \
+                    ('loadbalancer', loadbalancer.id) not in deletes:
+                # The service brings the agent up to date with every create
+                # and update of the loadbalancer
+                services.append(
+                    builder.service_from_loadbalancer(loadbalancer))
+                for key in statuses:
+                    if key not in deletes:
+                        RESENDS.inc(entity_type=key[0], operation='sync')
+                        sent.append(key)
+                statuses = deletes
+            resends.append((loadbalancer, statuses))
+
+        if services:
+            self.driver.agent_rpc.sync_services(context, agent.host,
+                                                services, last=True)
+        for loadbalancer, statuses in resends:
+            sent.extend(self.resend(context, agent, loadbalancer, statuses))
+
+        with self._lock:
+            for key in sent:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    pending.since = now
+                    pending.attempts += 1
+        return len(sent)
+
+    def resend(self, context, agent, loadbalancer, statuses):
+        """Send again the operations of entities of a loadbalancer.
+
+        statuses maps the (entity_type, id) of the entities to their
+        PENDING_* provisioning status, which gives the operation to send.
+        The entities are sent one by one, creates parents first, then
+        deletes children first. Updates need the old entity, which is lost,
+        so they are not sent: sync_services sends them again. Returns the
+        keys of the entities sent.
+        """
+        updates = sorted(key for key, status in statuses.items()
+                         if status == plugin_constants.PENDING_UPDATE)
+        if updates:
+            LOG.warning('Agent %s cannot resynchronize services, the '
+                        'updates of %s are not sent again', agent['host'],
+                        ', '.join('%s %s' % key for key in updates))
+        host = agent['host']
+        entities = walk_loadbalancer(loadbalancer)
+        sent = []
+        with serializer.scope():
+            for entity_type in CREATE_ORDER:
+                sent.extend(self._send_all(
+                    context, host, loadbalancer, entities, statuses,
+                    entity_type, plugin_constants.PENDING_CREATE))
+            for entity_type in db_api.DELETE_ORDER:
+                sent.extend(self._send_all(
+                    context, host, loadbalancer, entities, statuses,
+                    entity_type, plugin_constants.PENDING_DELETE))
+        if sent:
+            self.driver.member_batcher.flush(loadbalancer.id)
+        return sent
+
+    def _send_all(self, context, host, loadbalancer, entities, statuses,
+                  entity_type, status):
+        # Sends the operation of the entities of a type in a status
+        keys = sorted(key for key, entity_status in statuses.items()
+                      if key[0] == entity_type and key in entities and
+                      entity_status == status)
+        manager = getattr(self.driver, entity_type)
+        for key in keys:
+            if status == plugin_constants.PENDING_CREATE:
+                manager.send_create(context, entities[key],
+                                    loadbalancer=loadbalancer, host=host)
+                RESENDS.inc(entity_type=entity_type, operation='create')
+            else:
+                manager.send_delete(context, entities[key],
+                                    loadbalancer=loadbalancer, host=host)
+                RESENDS.inc(entity_type=entity_type, operation='delete')
+        return keys
+
+
+class ReconcilerWorker(worker.BaseWorker):
+    """Run a reconciler in a single neutron-server process.
+
+    Registered with the plugin, so that stuck entities are sent again once
+    however many API workers load the driver.
+    """
+
+    def __init__(self, reconciler):
+        super(ReconcilerWorker, self).__init__(worker_process_count=1)
+        self.reconciler = reconciler
+
+    def start(self, *args, **kwargs):
+        super(ReconcilerWorker, self).start(*args, **kwargs)
+        self.reconciler.start()
+
+    def stop(self):
+        self.reconciler.stop()
+
+    def wait(self):
+        pass
+
+    def reset(self):
+        pass
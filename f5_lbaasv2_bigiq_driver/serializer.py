@@ -0,0 +1,40 @@
+import contextlib
+import threading
+
+# Serialized entities of the scope open in each thread, by entity identity
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def scope():
+    """Serialize each entity once within the block.
+
+    For a block sending several casts built from the same entities, like
+    the operations resent for a loadbalancer. Entities must not change
+    within the block. Scopes do not nest: an inner one uses the outer one.
+    """
+    if getattr(_local, 'serialized', None) is not None:
+        yield
+        return
+    _local.serialized = {}
+    try:
+        yield
+    finally:
+        _local.serialized = None
+
+
+def to_api_dict(entity):
+    """Return entity.to_api_dict(), serialized once in the current scope.
+
+    Outside of a scope the entity is serialized on every call. The
+    returned dict may be shared and must not be modified.
+    """
+    serialized = getattr(_local, 'serialized', None)
+    if serialized is None:
+        return entity.to_api_dict()
+    # The entity is kept in the entry so that its id is not reused
+    entry = serialized.get(id(entity))
+    if entry is None:
+        entry = (entity, entity.to_api_dict())
+        serialized[id(entity)] = entry
+    return entry[1]
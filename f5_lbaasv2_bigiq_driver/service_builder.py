@@ -0,0 +1,139 @@
+from oslo_log import log as logging
+from sqlalchemy import orm
+
+from neutron.db.models import agent as agents_db
+from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import data_models
+
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import db_api
+
+LOG = logging.getLogger(__name__)
+
+
+class LBaaSv2ServiceBuilder(object):
+    """Build the service trees of loadbalancers for the BIG-IQ agents.
+
+    A service holds a loadbalancer and all of its children, each kind in
+    its own list, as the agent needs them to redeploy the loadbalancer.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def get_loadbalancer_ids(self, context, host, marker=None, limit=None):
+        """Return the ids of the loadbalancers bound to an agent host.
+
+        Ids are sorted, so that a page starts after the marker id.
+        """
+        binding = agent_scheduler.LoadbalancerAgentBinding
+        query = context.session.query(binding.loadbalancer_id).join(
+            agents_db.Agent, agents_db.Agent.id == binding.agent_id)
+        query = query.filter(
+            agents_db.Agent.agent_type == constants.LBAASV2_BIGIQ_AGENT_TYPE,
+            agents_db.Agent.host == host)
+        if marker:
+            query = query.filter(binding.loadbalancer_id > marker)
+        query = query.order_by(binding.loadbalancer_id)
+        if limit:
+            query = query.limit(limit)
+        return [row.loadbalancer_id for row in query]
+
+    def get_loadbalancers(self, context, loadbalancer_ids):
+        """Return the status summary of loadbalancers."""
+        if not loadbalancer_ids:
+            return []
+        query = context.session.query(
+            models.LoadBalancer.id, models.LoadBalancer.project_id,
+            models.LoadBalancer.provisioning_status,
+            models.LoadBalancer.operating_status)
+        query = query.filter(models.LoadBalancer.id.in_(loadbalancer_ids))
+        query = query.order_by(models.LoadBalancer.id)
+        return [{'id': row.id,
+                 'tenant_id': row.project_id,
+                 'provisioning_status': row.provisioning_status,
+                 'operating_status': row.operating_status}
+                for row in query]
+
+    @staticmethod
+    def service_from_loadbalancer(loadbalancer):
+        """Return the service of a loadbalancer data model."""
+        service = {
+            'loadbalancer': loadbalancer.to_api_dict(),
+            'listeners': [],
+            'pools': [],
+            'members': [],
+            'healthmonitors': [],
+            'l7policies': [],
+            'l7policy_rules': []
+        }
+        for listener in loadbalancer.listeners:
+            service['listeners'].append(listener.to_api_dict())
+            for l7policy in listener.l7_policies:
+                service['l7policies'].append(l7policy.to_api_dict())
+                for l7rule in l7policy.rules:
+                    service['l7policy_rules'].append(l7rule.to_api_dict())
+        for pool in loadbalancer.pools:
+            service['pools'].append(pool.to_api_dict())
+            for member in pool.members:
+                service['members'].append(member.to_api_dict())
+            if pool.healthmonitor:
+                service['healthmonitors'].append(
+                    pool.healthmonitor.to_api_dict())
+        return service
+
+    @staticmethod
+    def _eager_load_options():
+        # Load every relationship walked by from_sqlalchemy_model with one
+        # query per relationship, whatever the number of loadbalancers.
+        # Many-to-one relationships back to objects already loaded, like
+        # Listener.default_pool, are then resolved from the identity map.
+        # HealthMonitorV2.pool is not: the foreign key is on the pool.
+        listeners = orm.selectinload(models.LoadBalancer.listeners)
+        l7policies = listeners.selectinload(models.Listener.l7_policies)
+        pools = orm.selectinload(models.LoadBalancer.pools)
+        healthmonitors = pools.selectinload(models.PoolV2.healthmonitor)
+        return [
+            orm.joinedload(models.LoadBalancer.vip_port),
+            orm.joinedload(models.LoadBalancer.stats),
+            orm.joinedload(models.LoadBalancer.provider),
+            listeners.selectinload(models.Listener.sni_containers),
+            l7policies.selectinload(models.L7Policy.rules),
+            pools.selectinload(models.PoolV2.members),
+            healthmonitors.selectinload(models.HealthMonitorV2.pool),
+            pools.selectinload(models.PoolV2.session_persistence),
+            pools.selectinload(models.PoolV2.listeners),
+            pools.selectinload(models.PoolV2.l7_policies),
+        ]
+
+    def get_loadbalancer_models(self, context, loadbalancer_ids):
+        """Return the data models of loadbalancers with their whole graph.
+
+        Loadbalancers which do not exist are left out.
+        """
+        loadbalancers = []
+        for chunk in db_api.chunks(loadbalancer_ids):
+            query = context.session.query(models.LoadBalancer)
+            query = query.filter(models.LoadBalancer.id.in_(chunk))
+            query = query.options(*self._eager_load_options())
+            loadbalancers.extend(
+                data_models.LoadBalancer.from_sqlalchemy_model(lb_db)
+                for lb_db in query)
+        return loadbalancers
+
+    def build(self, context, loadbalancer_id):
+        """Return the service of a loadbalancer, or None if it is gone."""
+        services = self.build_many(context, [loadbalancer_id])
+        return services[0] if services else None
+
+    def build_many(self, context, loadbalancer_ids):
+        """Return the services of loadbalancers, skipping deleted ones.
+
+        The services are in the order of loadbalancer_ids.
+        """
+        loadbalancers = dict(
+            (loadbalancer.id, loadbalancer) for loadbalancer in
+            self.get_loadbalancer_models(context, loadbalancer_ids))
+        return [self.service_from_loadbalancer(loadbalancers[lb_id])
+                for lb_id in loadbalancer_ids if lb_id in loadbalancers]
@@ -0,0 +1,183 @@
+import collections
+import threading
+
+from neutron_lib import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+from neutron_lbaas.db.loadbalancer import models
+
+from f5_lbaasv2_bigiq_driver import cache
+from f5_lbaasv2_bigiq_driver import db_api
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_stats_ttl',
+        default=60,
+        help=('Seconds loadbalancer stats pushed by the BIG-IQ agent are '
+              'fresh. Reading stale or missing stats requests newer ones '
+              'from the agent, at most once per period.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_stats_cache_size',
+        default=10000,
+        help=('Maximum number of loadbalancers whose latest stats push is '
+              'tracked in memory.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_stats_flush_interval',
+        default=10,
+        help=('Seconds between writes of buffered loadbalancer stats to '
+              'the DB. 0 writes the stats as soon as they are received.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_stats_flush_size',
+        default=500,
+        help=('Number of buffered loadbalancer stats that triggers a write '
+              'to the DB before the flush interval elapses.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_stats_buffer_size',
+        default=20000,
+        help=('Maximum number of loadbalancer stats kept in the buffer '
+              'while the DB cannot be written. The oldest are dropped '
+              'beyond it.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class StatsCache(object):
+    """When the BIG-IQ agents last pushed the stats of loadbalancers.
+
+    The stats themselves go to the DB through StatsWriter, which the
+    plugin reads them from.
+    """
+
+    def __init__(self):
+        self.ttl = cfg.CONF.f5_bigiq_stats_ttl
+        self._updated = cache.LRUCache(cfg.CONF.f5_bigiq_stats_cache_size,
+                                       self.ttl)
+        # Loadbalancers with a refresh requested within the last ttl
+        self._refreshing = cache.LRUCache(
+            cfg.CONF.f5_bigiq_stats_cache_size, self.ttl)
+        self._lock = threading.Lock()
+
+    def update(self, loadbalancer_id):
+        self._updated.set(loadbalancer_id, True)
+        self._refreshing.pop(loadbalancer_id)
+
+    def is_fresh(self, loadbalancer_id):
+        """Whether stats were pushed for the loadbalancer within ttl."""
+        return bool(self._updated.get(loadbalancer_id))
+
+    def start_refresh(self, loadbalancer_id):
+        """Whether a refresh should be requested for the loadbalancer.
+
+        Returns true at most once per ttl for a loadbalancer, so that
+        frequent polling does not flood the agent with requests.
+        """
+        with self._lock:
+            if self._refreshing.get(loadbalancer_id):
+                return False
+            self._refreshing.set(loadbalancer_id, True)
+        return True
+
+    def pop(self, loadbalancer_id):
+        self._refreshing.pop(loadbalancer_id)
+        self._updated.pop(loadbalancer_id)
+
+
+class StatsWriter(object):
+    """Write-behind buffer of loadbalancer stats.
+
+    Only the latest stats of a loadbalancer are kept. The buffer is
+    written to the DB in one transaction every flush interval, or as soon
+    as it holds flush size loadbalancers. It holds at most buffer size
+    loadbalancers, the oldest stats being dropped beyond, so that a DB
+    which cannot be written does not grow it for good.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.interval = cfg.CONF.f5_bigiq_stats_flush_interval
+        self.flush_size = max(cfg.CONF.f5_bigiq_stats_flush_size, 1)
+        self.max_size = max(cfg.CONF.f5_bigiq_stats_buffer_size,
+                            self.flush_size)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._loop = None
+        self.dropped = 0
+
+    def start(self):
+        if self.interval > 0 and self._loop is None:
+            self._loop = loopingcall.FixedIntervalLoopingCall(self.flush)
+            self._loop.start(interval=self.interval)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+        self.flush()
+
+    def add(self, loadbalancer_id, stats):
+        with self._lock:
+            self._pending.pop(loadbalancer_id, None)
+            self._pending[loadbalancer_id] = stats
+            self._trim(self._pending)
+            full = len(self._pending) >= self.flush_size
+        if full or self.interval <= 0:
+            self.flush()
+
+    def _trim(self, pending):
+        # Drops the oldest stats beyond max_size, with the lock held
+        dropped = 0
+        while len(pending) > self.max_size:
+            pending.popitem(last=False)
+            dropped += 1
+        self.dropped += dropped
+        return dropped
+
+    def flush(self):
+        """Write the buffered stats to the DB."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = collections.OrderedDict()
+            if not pending:
+                return
+
+            context = neutron_context.get_admin_context()
+            try:
+                with context.session.begin(subtransactions=True):
+                    # Skip the loadbalancers deleted in the meantime, since
+                    # a missing one would fail the whole transaction.
+                    existing = set()
+                    for chunk in db_api.chunks(pending):
+                        query = context.session.query(models.LoadBalancer.id)
+                        query = query.filter(models.LoadBalancer.id.in_(chunk))
+                        existing.update(row.id for row in query)
+                    for loadbalancer_id, stats in pending.items():
+                        if loadbalancer_id in existing:
+                            self.plugin.db.update_loadbalancer_stats(
+                                context, loadbalancer_id, stats)
+            except Exception as e:
+                LOG.error('Failed to write stats of %d loadbalancers: %s',
+                          len(pending), e)
+                self._restore(pending)
+
+    def _restore(self, pending):
+        with self._lock:
+            # Stats received during the flush are newer than the failed ones
+            for loadbalancer_id in self._pending:
+                pending.pop(loadbalancer_id, None)
+            pending.update(self._pending)
+            dropped = self._trim(pending)
+            self._pending = pending
+        if dropped:
+            LOG.warning('Dropped buffered stats of %d loadbalancers', dropped)
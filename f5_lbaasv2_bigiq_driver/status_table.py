@@ -0,0 +1,141 @@
+import threading
+import time
+
+from oslo_config import cfg
+
+from f5_lbaasv2_bigiq_driver import cache
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_status_table_size',
+        default=50000,
+        help=('Maximum number of resources whose last reported status is '
+              'kept in memory to drop repeated status reports. 0 disables '
+              'the deduplication and the sequence check.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_status_table_ttl',
+        default=600,
+        help=('Seconds the last reported status and sequence of a resource '
+              'are kept.')
+    ),
+    cfg.FloatOpt(
+        'f5_bigiq_status_dedupe_window',
+        default=0,
+        help=('Seconds during which a repeated report of the same '
+              'provisioning status is dropped. API requests change the '
+              'provisioning status too, and those handled by other API '
+              'workers or servers go unnoticed: a dropped report could '
+              'leave a resource in PENDING_* for good. Only set it with a '
+              'single API worker. 0 writes every report carrying a '
+              'provisioning status, which the conditional UPDATE makes '
+              'harmless to repeat. Repeated operating statuses, only '
+              'changed by the agents, are dropped for '
+              'f5_bigiq_status_table_ttl.')
+    ),
+    cfg.BoolOpt(
+        'f5_bigiq_status_sequence_check',
+        default=False,
+        help=('Drop status reports whose (epoch, sequence) is not newer '
+              'than the last report applied for the resource, for agents '
+              'numbering their reports.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+
+class _Status(object):
+
+    def __init__(self, provisioning_status, operating_status, order,
+                 recorded_at):
+        self.provisioning_status = provisioning_status
+        self.operating_status = operating_status
+        self.order = order
+        self.recorded_at = recorded_at
+
+
+def _order(sequence, epoch):
+    if sequence is None:
+        return None
+    return (epoch or 0, sequence)
+
+
+class StatusTable(object):
+    """Last status reported by the agents for each resource.
+
+    A report is written to the DB and then recorded. A new report of the
+    recorded operating status and no provisioning status is a retry or a
+    no-op and is dropped. Reports carrying a provisioning status are only
+    dropped as repeats within f5_bigiq_status_dedupe_window, 0 by default.
+    When the sequence check is enabled, a report numbered lower than the
+    recorded one is late and is dropped. Operations dispatched by this
+    worker invalidate the status of their entity and loadbalancer, since
+    the API changed them.
+    """
+
+    def __init__(self):
+        self.dedupe_window = cfg.CONF.f5_bigiq_status_dedupe_window
+        self.sequence_check = cfg.CONF.f5_bigiq_status_sequence_check
+        self._statuses = cache.LRUCache(cfg.CONF.f5_bigiq_status_table_size,
+                                        cfg.CONF.f5_bigiq_status_table_ttl)
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.stale = 0
+
+    def accept(self, resource_type, resource_id, provisioning_status,
+               operating_status, sequence=None, epoch=None):
+        """Whether a status report must be written to the DB."""
+        last = self._statuses.get((resource_type, resource_id))
+        if last is None:
+            return True
+
+        order = _order(sequence, epoch)
+        if self.sequence_check and order is not None and \
+                last.order is not None and order <= last.order:
+            with self._lock:
+                self.stale += 1
+            return False
+
+        if operating_status != last.operating_status:
+            return True
+        if provisioning_status is not None and (
+                self.dedupe_window <= 0 or
+                provisioning_status != last.provisioning_status or
+                time.time() - last.recorded_at >= self.dedupe_window):
+            return True
+        with self._lock:
+            self.duplicates += 1
+        return False
+
+    def record(self, resource_type, resource_id, provisioning_status,
+               operating_status, sequence=None, epoch=None):
+        """Record a status report written to the DB."""
+        key = (resource_type, resource_id)
+        order = _order(sequence, epoch)
+        if order is None:
+            # Keep the order of the last numbered report
+            last = self._statuses.get(key)
+            order = last.order if last is not None else None
+        self._statuses.set(key, _Status(provisioning_status, operating_status,
+                                        order, time.time()))
+
+    def invalidate(self, resource_type, resource_id):
+        """Forget the status of a resource, keeping its report order."""
+        key = (resource_type, resource_id)
+        last = self._statuses.get(key)
+        if last is None:
+            return
+        if last.order is None:
+            self._statuses.pop(key)
+        else:
+            self._statuses.set(key, _Status(None, None, last.order, 0))
+
+    def pop(self, resource_type, resource_id):
+        self._statuses.pop((resource_type, resource_id))
+
+    def stats(self):
+        stats = self._statuses.stats()
+        return {'size': stats['size'],
+                'duplicates': self.duplicates,
+                'stale': self.stale}
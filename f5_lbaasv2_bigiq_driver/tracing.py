@@ -0,0 +1,162 @@
+import collections
+import threading
+import time
+
+from neutron_lib import constants as plugin_constants
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from f5_lbaasv2_bigiq_driver import cache
+from f5_lbaasv2_bigiq_driver import metrics
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt(
+        'f5_bigiq_trace_max_pending',
+        default=20000,
+        help=('Maximum number of entity operations waiting for their final '
+              'status whose provisioning latency is traced. 0 only traces '
+              'from the casts echoed by the agents.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_trace_timeout',
+        default=3600,
+        help=('Seconds after which an operation still waiting for its '
+              'final status is no longer traced.')
+    ),
+    cfg.FloatOpt(
+        'f5_bigiq_trace_slow_threshold',
+        default=30.0,
+        help=('Provisioning latency in seconds above which an operation is '
+              'logged as slow.')
+    ),
+    cfg.IntOpt(
+        'f5_bigiq_trace_samples',
+        default=1000,
+        help=('Number of latest provisioning latencies kept per entity type '
+              'and operation to compute percentiles.')
+    )
+]
+
+cfg.CONF.register_opts(OPTS)
+
+DELETED = 'DELETED'
+FINAL_STATUSES = (plugin_constants.ACTIVE, plugin_constants.ERROR, DELETED)
+
+PROVISIONING_SECONDS = metrics.REGISTRY.histogram(
+    'f5_bigiq_provisioning_seconds',
+    'Time from an API call to the final status reported by the agent.',
+    ('entity_type', 'operation', 'status'),
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
+             1800.0))
+
+
+def make_trace(context, method):
+    """Return the trace stamped on a cast of a request."""
+    return {'trace_id': getattr(context, 'request_id', None),
+            'operation': method.split('_', 1)[0],
+            'sent_at': time.time()}
+
+
+class _Trace(object):
+
+    def __init__(self, trace_id, operation, started_at):
+        self.trace_id = trace_id
+        self.operation = operation
+        self.started_at = started_at
+
+
+class Tracer(object):
+    """Provisioning latency of entities, from API call to final status.
+
+    An operation is started when the driver receives it from the plugin,
+    with the request id as trace id, and finished by the first status
+    callback with a final status for the entity. Successive operations on
+    an entity before its final status make one trace, started by the
+    first of them.
+
+    Callbacks handled by another API worker than the one which started the
+    trace are still measured when the agent echoes the trace stamped on
+    the cast, from the cast instead of the API call.
+    """
+
+    def __init__(self):
+        self.slow_threshold = cfg.CONF.f5_bigiq_trace_slow_threshold
+        self.timeout = cfg.CONF.f5_bigiq_trace_timeout
+        self._pending = cache.LRUCache(cfg.CONF.f5_bigiq_trace_max_pending,
+                                       self.timeout)
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(
+            lambda: collections.deque(
+                maxlen=max(cfg.CONF.f5_bigiq_trace_samples, 1)))
+        self.finished = 0
+        self.slow = 0
+
+    def start(self, context, entity_type, entity_id, operation):
+        key = (entity_type, entity_id)
+        with self._lock:
+            if self._pending.get(key) is None:
+                self._pending.set(key, _Trace(
+                    getattr(context, 'request_id', None), operation,
+                    time.time()))
+
+    def finish(self, entity_type, entity_id, status, trace=None):
+        """Record the latency of an entity reaching a final status.
+
+        trace is the trace echoed by the agent, if any.
+        """
+        if status not in FINAL_STATUSES:
+            return
+        with self._lock:
+            started = self._pending.pop((entity_type, entity_id))
+        if started is not None and \
+                time.time() - started.started_at < self.timeout:
+            trace_id = started.trace_id
+            operation = started.operation
+            latency = time.time() - started.started_at
+        elif trace and trace.get('sent_at'):
+            trace_id = trace.get('trace_id')
+            operation = trace.get('operation', 'unknown')
+            latency = time.time() - trace['sent_at']
+        else:
+            return
+
+        PROVISIONING_SECONDS.observe(latency, entity_type=entity_type,
+                                     operation=operation, status=status)
+        with self._lock:
+            self._samples[(entity_type, operation)].append(latency)
+            self.finished += 1
+            if latency >= self.slow_threshold:
+                self.slow += 1
+        if latency >= self.slow_threshold:
+            LOG.warning('Slow %s of %s %s: %s after %.1f seconds, trace %s',
+                        operation, entity_type, entity_id, status, latency,
+                        trace_id)
+
+    def finish_many(self, statuses):
+        """Finish the traces of (entity_type, entity_id, status) tuples."""
+        for entity_type, entity_id, status in statuses:
+            self.finish(entity_type, entity_id, status)
+
+    def percentiles(self, percents=(50, 90, 99)):
+        """Return {(entity_type, operation): {percent: latency}}."""
+        with self._lock:
+            samples = dict((key, sorted(values))
+                           for key, values in self._samples.items())
+        result = {}
+        for key, values in samples.items():
+            if not values:
+                continue
+            result[key] = dict(
+                (percent, values[min(len(values) - 1,
+                                     int(len(values) * percent / 100.0))])
+                for percent in percents)
+        return result
+
+    def stats(self):
+        stats = self._pending.stats()
+        return {'pending': stats['size'],
+                'finished': self.finished,
+                'slow': self.slow,
+                'percentiles': self.percentiles()}
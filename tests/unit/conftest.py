@@ -0,0 +1,162 @@
+from neutron.db.migration.models import head  # noqa
+from neutron.db.models import agent as agents_db
+from neutron_lib import constants as n_const
+from neutron_lib import context as neutron_context
+from neutron_lib.db import api as db_api
+from neutron_lib.db import model_base
+from oslo_config import cfg
+from oslo_db import options as db_options
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+from oslo_utils import uuidutils
+import pytest
+from sqlalchemy import event
+
+from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import constants as lb_const
+
+from f5_lbaasv2_bigiq_driver import constants
+
+PROJECT_ID = 'test-project'
+
+
+class QueryCounter(object):
+    """Count the SQL statements run on an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+class Factory(object):
+    """Add agents and loadbalancer graphs to the test DB."""
+
+    def __init__(self, context):
+        self.context = context
+
+    def add_agent(self, host='test-agent',
+                  version=constants.RPC_API_VERSION, group=None, **kwargs):
+        configurations = {'rpc_api_version': version}
+        if group is not None:
+            configurations['agent_group'] = group
+        agent = agents_db.Agent(
+            id=uuidutils.generate_uuid(),
+            agent_type=constants.LBAASV2_BIGIQ_AGENT_TYPE,
+            binary='f5-oslbaasv2-bigiq-agent',
+            topic=constants.TOPIC_LBAASV2_BIGIQ_AGENT,
+            host=host,
+            admin_state_up=kwargs.pop('admin_state_up', True),
+            created_at=timeutils.utcnow(),
+            started_at=timeutils.utcnow(),
+            heartbeat_timestamp=kwargs.pop('heartbeat_timestamp',
+                                           timeutils.utcnow()),
+            configurations=jsonutils.dumps(configurations),
+            **kwargs)
+        with self.context.session.begin(subtransactions=True):
+            self.context.session.add(agent)
+        return agent
+
+    def add_loadbalancer(self, agent=None, listeners=1, pools=1, members=1,
+                         l7policies=0, l7rules=0, healthmonitor=False,
+                         status=n_const.ACTIVE):
+        """Add a loadbalancer and its children, all in the same status.
+
+        Listener i uses pool i as its default pool, and its L7 policies
+        redirect to that pool.
+        """
+        # Health monitors and L7 entities have no operating status
+        common = {'project_id': PROJECT_ID,
+                  'provisioning_status': status,
+                  'admin_state_up': True}
+        online = dict(common, operating_status=lb_const.ONLINE)
+        lb_id = uuidutils.generate_uuid()
+        session = self.context.session
+        with session.begin(subtransactions=True):
+            session.add(models.LoadBalancer(
+                id=lb_id, name='test',
+                vip_subnet_id=uuidutils.generate_uuid(),
+                vip_address='10.0.0.10', **online))
+            pool_ids = []
+            for _ in range(pools):
+                pool_id = uuidutils.generate_uuid()
+                pool_ids.append(pool_id)
+                healthmonitor_id = None
+                if healthmonitor:
+                    healthmonitor_id = uuidutils.generate_uuid()
+                    session.add(models.HealthMonitorV2(
+                        id=healthmonitor_id, type='HTTP', delay=5,
+                        timeout=5, max_retries=3, **common))
+                session.add(models.PoolV2(
+                    id=pool_id, loadbalancer_id=lb_id,
+                    healthmonitor_id=healthmonitor_id, protocol='HTTP',
+                    lb_algorithm='ROUND_ROBIN', **online))
+                for index in range(members):
+                    session.add(models.MemberV2(
+                        id=uuidutils.generate_uuid(), pool_id=pool_id,
+                        address='10.1.%d.%d' % divmod(index, 250),
+                        protocol_port=8080, weight=1, **online))
+            for index in range(listeners):
+                pool_id = pool_ids[index] if index < len(pool_ids) else None
+                listener_id = uuidutils.generate_uuid()
+                session.add(models.Listener(
+                    id=listener_id, loadbalancer_id=lb_id,
+                    default_pool_id=pool_id, protocol='HTTP',
+                    protocol_port=80 + index, connection_limit=-1, **online))
+                for position in range(l7policies):
+                    policy_id = uuidutils.generate_uuid()
+                    session.add(models.L7Policy(
+                        id=policy_id, listener_id=listener_id,
+                        action='REDIRECT_TO_POOL', redirect_pool_id=pool_id,
+                        position=position + 1, **common))
+                    for _ in range(l7rules):
+                        session.add(models.L7Rule(
+                            id=uuidutils.generate_uuid(),
+                            l7policy_id=policy_id, type='PATH',
+                            compare_type='STARTS_WITH', value='/api',
+                            invert=False, **common))
+            if agent is not None:
+                session.flush()
+                binding = agent_scheduler.LoadbalancerAgentBinding()
+                binding.agent_id = agent.id
+                binding.loadbalancer_id = lb_id
+                session.add(binding)
+        return lb_id
+
+
+@pytest.fixture(scope='session')
+def engine():
+    cfg.CONF([], project='neutron')
+    db_options.set_defaults(cfg.CONF, connection='sqlite://')
+    engine = db_api.get_context_manager().writer.get_engine()
+    model_base.BASEV2.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def context(engine):
+    context = neutron_context.get_admin_context()
+    yield context
+    context.session.expunge_all()
+    with engine.begin() as connection:
+        for table in reversed(model_base.BASEV2.metadata.sorted_tables):
+            connection.execute(table.delete())
+
+
+@pytest.fixture
+def factory(context):
+    return Factory(context)
+
+
+@pytest.fixture
+def query_counter(engine):
+    counter = QueryCounter(engine)
+    yield counter
+    counter.close()
@@ -0,0 +1,53 @@
+import datetime
+
+import mock
+from oslo_utils import timeutils
+
+from neutron_lbaas import agent_scheduler as lbaas_agent_scheduler
+
+from f5_lbaasv2_bigiq_driver import agent_monitor
+from f5_lbaasv2_bigiq_driver import agent_scheduler
+from f5_lbaasv2_bigiq_driver import service_builder
+
+
+def _monitor():
+    driver = mock.Mock()
+    driver.scheduler = agent_scheduler.LeastLoadedScheduler()
+    driver.service_builder = service_builder.LBaaSv2ServiceBuilder(driver)
+    return agent_monitor.AgentMonitor(driver)
+
+
+def _bound_hosts(context):
+    binding = lbaas_agent_scheduler.LoadbalancerAgentBinding
+    return sorted(binding.agent.host for binding in
+                  context.session.query(binding))
+
+
+def test_failover_stays_in_the_group_of_the_dead_agent(context, factory):
+    dead = factory.add_agent(
+        host='dead', group='east',
+        heartbeat_timestamp=timeutils.utcnow() - datetime.timedelta(
+            hours=1))
+    factory.add_agent(host='east', group='east')
+    factory.add_agent(host='west', group='west')
+    factory.add_agent(host='ungrouped')
+    for _ in range(4):
+        factory.add_loadbalancer(agent=dead)
+
+    assert _monitor().failover(context, dead) == 4
+
+    assert _bound_hosts(context) == ['east'] * 4
+
+
+def test_failover_of_ungrouped_agent_skips_grouped_ones(context, factory):
+    dead = factory.add_agent(
+        host='dead',
+        heartbeat_timestamp=timeutils.utcnow() - datetime.timedelta(
+            hours=1))
+    factory.add_agent(host='east', group='east')
+    factory.add_agent(host='ungrouped')
+    factory.add_loadbalancer(agent=dead)
+
+    assert _monitor().failover(context, dead) == 1
+
+    assert _bound_hosts(context) == ['ungrouped']
@@ -0,0 +1,102 @@
+import mock
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+
+from f5_lbaasv2_bigiq_driver import agent_rpc
+from f5_lbaasv2_bigiq_driver import cast_pool
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import metrics
+
+
+def _agent(version=None):
+    configurations = {}
+    if version is not None:
+        configurations['rpc_api_version'] = version
+    return {'host': 'host', 'configurations': configurations}
+
+
+def test_supports():
+    supports = agent_rpc.BIGIQAgentRPC.supports
+    batch_members = constants.RPC_API_VERSION_BATCH_MEMBERS
+
+    assert supports(_agent('1.1'), batch_members)
+    assert supports(_agent('1.10'), batch_members)
+    assert not supports(_agent('1.0'), batch_members)
+    assert not supports(_agent('2.1'), batch_members)
+    # Agents which report no version implement the first one
+    assert not supports(_agent(), batch_members)
+    assert supports(_agent(), constants.RPC_API_VERSION)
+
+
+@mock.patch.object(agent_rpc.BIGIQAgentRPC, '_create_rpc_publisher',
+                   mock.Mock())
+def test_payload_size_is_sampled_without_compression():
+    cfg.CONF.set_override('f5_bigiq_metrics_payload_sample_rate', 1)
+    agent_api = agent_rpc.BIGIQAgentRPC()
+    agent_api._client = mock.Mock()
+    pool = {'id': 'pool-1', 'name': 'test'}
+    count = sum(metrics.RPC_PAYLOAD_BYTES._values.get(
+        ('create_pool',), ([0], 0))[0])
+    try:
+        agent_api.create_pool(mock.Mock(), 'host', pool, loadbalancer={})
+    finally:
+        cfg.CONF.clear_override('f5_bigiq_metrics_payload_sample_rate')
+
+    counts, total = metrics.RPC_PAYLOAD_BYTES._values[('create_pool',)]
+    assert sum(counts) == count + 1
+    assert agent_api._client.prepare.return_value.cast.called
+    assert total >= len(jsonutils.dump_as_bytes(
+        {'pool': pool, 'loadbalancer': {}}))
+
+
+def test_failed_statuses():
+    failed = agent_rpc._failed_statuses
+    loadbalancer = {'id': 'lb-1'}
+
+    assert failed('create_health_monitor', {
+        'health_monitor': {'id': 'hm-1'}, 'loadbalancer': loadbalancer}) == [
+        ('health_monitor', 'hm-1', 'ERROR', None),
+        ('loadbalancer', 'lb-1', 'ACTIVE', None)]
+    assert failed('delete_loadbalancer', {'loadbalancer': loadbalancer}) == [
+        ('loadbalancer', 'lb-1', 'ERROR', None)]
+    assert failed('batch_members', {
+        'loadbalancer': loadbalancer,
+        'members': [{'operation': 'create', 'member': {'id': 'm-1'}}]}) == [
+        ('member', 'm-1', 'ERROR', None),
+        ('loadbalancer', 'lb-1', 'ACTIVE', None)]
+    assert failed('update_delta', {
+        'entity_type': 'pool', 'entity_id': 'pool-1',
+        'loadbalancer_id': 'lb-1', 'changes': {}}) == [
+        ('pool', 'pool-1', 'ERROR', None),
+        ('loadbalancer', 'lb-1', 'ACTIVE', None)]
+    assert failed('update_loadbalancer_stats',
+                  {'loadbalancer': loadbalancer}) == []
+    assert failed('sync_services', {'services': []}) == []
+
+
+@mock.patch.object(agent_rpc.BIGIQAgentRPC, '_create_rpc_publisher',
+                   mock.Mock())
+def test_failed_queued_cast_sets_error():
+    cfg.CONF.set_override('f5_bigiq_rpc_dispatch_mode', 'async')
+    try:
+        driver = mock.Mock()
+        agent_api = agent_rpc.BIGIQAgentRPC(driver)
+    finally:
+        cfg.CONF.clear_override('f5_bigiq_rpc_dispatch_mode')
+    agent_api._client = mock.Mock()
+    agent_api._client.prepare.return_value.cast.side_effect = [
+        RuntimeError(), None]
+
+    agent_api.create_pool(mock.Mock(request_id='req-1'), 'host',
+                          {'id': 'pool-1'}, loadbalancer={'id': 'lb-1'})
+    agent_api.sync_services(mock.Mock(), 'host', [])
+    agent_api.stop()
+
+    driver.plugin_rpc.update_statuses.assert_called_once_with(
+        mock.ANY, statuses=[('pool', 'pool-1', 'ERROR', None),
+                            ('loadbalancer', 'lb-1', 'ACTIVE', None)])
+    context = driver.plugin_rpc.update_statuses.call_args[0][0]
+    assert context.is_admin
+    assert context.request_id == 'req-1'
+    assert sum(cast_pool.QUEUE_SECONDS._values[()][0]) >= 2
+    assert cast_pool.QUEUE_DEPTH.value() == 0
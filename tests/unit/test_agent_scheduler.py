@@ -0,0 +1,42 @@
+import collections
+
+from neutron_lbaas.services.loadbalancer import data_models
+
+from f5_lbaasv2_bigiq_driver import agent_scheduler
+
+
+def _loadbalancers(count, tenant_id='tenant'):
+    return [data_models.LoadBalancer(id='lb-%s-%d' % (tenant_id, index),
+                                     tenant_id=tenant_id)
+            for index in range(count)]
+
+
+def _hosts(selected):
+    return collections.Counter(agent.host for agent in selected.values())
+
+
+def test_least_loaded_select_many_spreads_loadbalancers(context, factory):
+    agents = [factory.add_agent(host='host-%d' % index) for index in range(3)]
+    factory.add_loadbalancer(agent=agents[0])
+    loadbalancers = _loadbalancers(8)
+
+    selected = agent_scheduler.LeastLoadedScheduler().select_many(
+        context, loadbalancers, agents)
+
+    assert sorted(selected) == sorted(lb.id for lb in loadbalancers)
+    # 9 loadbalancers in all, host-0 already had one
+    assert _hosts(selected) == {'host-0': 2, 'host-1': 3, 'host-2': 3}
+
+
+def test_tenant_select_many_keeps_tenants_together(context, factory):
+    agents = [factory.add_agent(host='host-%d' % index) for index in range(2)]
+    loadbalancers = _loadbalancers(4, 'a') + _loadbalancers(4, 'b')
+
+    selected = agent_scheduler.TenantScheduler().select_many(
+        context, loadbalancers, agents)
+
+    hosts_a = set(selected[lb.id].host for lb in loadbalancers[:4])
+    hosts_b = set(selected[lb.id].host for lb in loadbalancers[4:])
+    assert len(hosts_a) == 1
+    assert len(hosts_b) == 1
+    assert hosts_a != hosts_b
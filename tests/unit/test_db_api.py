@@ -0,0 +1,59 @@
+from neutron_lbaas import agent_scheduler
+from neutron_lbaas.db.loadbalancer import models
+from neutron_lbaas.services.loadbalancer import constants as lb_const
+
+from f5_lbaasv2_bigiq_driver import db_api
+
+
+def _delete_resources(context, resources):
+    with context.session.begin(subtransactions=True):
+        deleted, vip_port_ids = db_api.delete_resources(context.session,
+                                                        resources)
+    context.session.expunge_all()
+    return deleted
+
+
+def test_delete_pools_like_the_plugin(context, factory):
+    lb_id = factory.add_loadbalancer(members=3, l7policies=2, l7rules=1)
+    pool_id = context.session.query(models.PoolV2.id).scalar()
+
+    deleted = _delete_resources(context, {'pool': [pool_id]})
+
+    assert deleted == {'pool': 1}
+    assert context.session.query(models.MemberV2).count() == 0
+    listener = context.session.query(models.Listener).one()
+    assert listener.loadbalancer_id == lb_id
+    assert listener.default_pool_id is None
+    policies = context.session.query(models.L7Policy).all()
+    assert len(policies) == 2
+    for policy in policies:
+        assert policy.redirect_pool_id is None
+        assert policy.action == lb_const.L7_POLICY_ACTION_REJECT
+    assert context.session.query(models.L7Rule).count() == 2
+
+
+def test_delete_children_first(context, factory):
+    agent = factory.add_agent()
+    lb_id = factory.add_loadbalancer(agent=agent, listeners=2, pools=2,
+                                     members=2, l7policies=1, l7rules=2,
+                                     healthmonitor=True)
+    other_id = factory.add_loadbalancer(agent=agent)
+    resources = {
+        'loadbalancer': [lb_id],
+        'listener': [row.id for row in context.session.query(
+            models.Listener.id).filter_by(loadbalancer_id=lb_id)],
+        'pool': [row.id for row in context.session.query(
+            models.PoolV2.id).filter_by(loadbalancer_id=lb_id)],
+    }
+
+    deleted = _delete_resources(context, resources)
+
+    assert deleted == {'listener': 2, 'pool': 2, 'loadbalancer': 1}
+    binding = agent_scheduler.LoadbalancerAgentBinding
+    assert [row.loadbalancer_id for row in
+            context.session.query(binding.loadbalancer_id)] == [other_id]
+    assert [row.id for row in context.session.query(
+        models.LoadBalancer.id)] == [other_id]
+    assert context.session.query(models.HealthMonitorV2).count() == 0
+    assert context.session.query(models.L7Rule).count() == 0
+    assert context.session.query(models.MemberV2).count() == 1
@@ -0,0 +1,36 @@
+import mock
+import pytest
+
+from f5_lbaasv2_bigiq_driver import dispatcher
+from f5_lbaasv2_bigiq_driver import exceptions
+
+
+def _operation(entity_type, entity_id, send_error=None):
+    manager = mock.Mock(entity_type=entity_type)
+    manager.send_create.side_effect = send_error
+    context = mock.Mock(request_id='req-1')
+    loadbalancer = mock.Mock(id='lb-1')
+    return dispatcher.Operation(manager, context, 'create',
+                                mock.Mock(id=entity_id),
+                                kwargs={'loadbalancer': loadbalancer})
+
+
+def test_operations_are_sent_at_once():
+    operation = _operation('pool', 'pool-1')
+
+    dispatcher.Dispatcher().dispatch(operation)
+
+    operation.manager.send_create.assert_called_once_with(
+        operation.context, operation.entity,
+        loadbalancer=operation.kwargs['loadbalancer'])
+    assert dispatcher.DISPATCH_DEPTH.value() == 0
+
+
+def test_failed_send_raises_to_the_plugin():
+    operation = _operation('pool', 'pool-1',
+                           exceptions.BIGIQAgentRPCQueueFull(size=1))
+
+    with pytest.raises(exceptions.BIGIQAgentRPCQueueFull):
+        dispatcher.Dispatcher().dispatch(operation)
+
+    assert dispatcher.DISPATCH_DEPTH.value() == 0
@@ -0,0 +1,68 @@
+import mock
+
+from f5_lbaasv2_bigiq_driver import cache
+from f5_lbaasv2_bigiq_driver import driver_bigiq
+
+
+def test_dispatch_invalidates_entity_and_loadbalancer_statuses():
+    driver = mock.Mock()
+    manager = driver_bigiq.EntityManager(driver)
+    manager.entity_type = 'pool'
+    loadbalancer = mock.Mock(id='lb-1')
+
+    manager.create(mock.Mock(), mock.Mock(id='pool-1'),
+                   loadbalancer=loadbalancer, host='host')
+
+    driver.status_table.invalidate.assert_has_calls(
+        [mock.call('pool', 'pool-1'), mock.call('loadbalancer', 'lb-1')],
+        any_order=True)
+    assert driver.dispatcher.dispatch.called
+
+
+def test_binding_cache_metrics():
+    binding_cache = cache.LRUCache(1)
+    driver_bigiq.export_binding_cache(binding_cache)
+    binding_cache.set('lb-1', 'agent-1')
+    binding_cache.get('lb-1')
+    binding_cache.get('lb-2')
+    binding_cache.set('lb-2', 'agent-1')
+
+    assert driver_bigiq.BINDING_CACHE_LOOKUPS.value(result='hit') == 1
+    assert driver_bigiq.BINDING_CACHE_LOOKUPS.value(result='miss') == 1
+    assert driver_bigiq.BINDING_CACHE_EVICTIONS.value() == 1
+    assert driver_bigiq.BINDING_CACHE_SIZE.value() == 1
+
+
+def _driver():
+    # A driver without the objects __init__ creates
+    driver = driver_bigiq.BIGIQDriver.__new__(driver_bigiq.BIGIQDriver)
+    for name in ('member_batcher', 'agent_rpc', 'stats_writer',
+                 'agent_monitor', 'reconciler', 'metrics_exporter'):
+        setattr(driver, name, mock.Mock())
+    return driver
+
+
+def test_worker_stop_stops_the_driver():
+    driver = _driver()
+    worker = mock.Mock()
+    stop_worker = worker.stop
+    stopped = []
+    driver.stats_writer.stop.side_effect = (
+        lambda: stopped.append(stop_worker.called))
+
+    driver._stop_with_worker(worker)
+    worker.stop()
+
+    stop_worker.assert_called_once_with()
+    # The worker stops taking requests before its buffers are written
+    assert stopped == [True]
+
+
+def test_stop_sends_and_writes_what_is_buffered():
+    driver = _driver()
+
+    driver.stop()
+
+    driver.member_batcher.flush_all.assert_called_once_with()
+    driver.agent_rpc.stop.assert_called_once_with()
+    driver.stats_writer.stop.assert_called_once_with()
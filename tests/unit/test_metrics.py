@@ -0,0 +1,80 @@
+import pytest
+
+from f5_lbaasv2_bigiq_driver import metrics
+
+
+def _outcomes(method):
+    return (metrics.CALLBACKS.value(method=method, outcome='success'),
+            metrics.CALLBACKS.value(method=method, outcome='error'))
+
+
+def test_metric_must_render_its_samples():
+    with pytest.raises(TypeError):
+        metrics._Metric('f5_bigiq_test', 'Test.')
+
+
+def test_callback_outcomes():
+    @metrics.callback
+    def test_callback_logged(fail):
+        if fail:
+            metrics.callback_failed()
+
+    @metrics.callback
+    def test_callback_raised():
+        raise ValueError()
+
+    test_callback_logged(False)
+    test_callback_logged(True)
+    test_callback_logged(False)
+    with pytest.raises(ValueError):
+        test_callback_raised()
+
+    assert _outcomes('test_callback_logged') == (2, 1)
+    assert _outcomes('test_callback_raised') == (0, 1)
+
+
+def test_nested_callback_failure_is_its_own():
+    @metrics.callback
+    def test_inner():
+        metrics.callback_failed()
+
+    @metrics.callback
+    def test_outer():
+        test_inner()
+
+    test_outer()
+
+    assert _outcomes('test_inner') == (0, 1)
+    assert _outcomes('test_outer') == (1, 0)
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('f5_bigiq_test_total', 'Test.', ('method',))
+    counter.inc(method='create')
+
+    assert registry.render() == (
+        '# HELP f5_bigiq_test_total Test.\n'
+        '# TYPE f5_bigiq_test_total counter\n'
+        'f5_bigiq_test_total{method="create"} 1\n')
+
+
+def test_render_gauge_and_function_values():
+    registry = metrics.Registry()
+    gauge = registry.gauge('f5_bigiq_test_depth', 'Test.')
+    gauge.inc(3)
+    gauge.dec()
+    counts = {'hit': 5}
+    counter = registry.counter('f5_bigiq_test_total', 'Test.', ('result',))
+    counter.set_function(lambda: counts['hit'], result='hit')
+    counts['hit'] += 1
+
+    assert gauge.value() == 2
+    assert counter.value(result='hit') == 6
+    assert registry.render() == (
+        '# HELP f5_bigiq_test_depth Test.\n'
+        '# TYPE f5_bigiq_test_depth gauge\n'
+        'f5_bigiq_test_depth 2\n'
+        '# HELP f5_bigiq_test_total Test.\n'
+        '# TYPE f5_bigiq_test_total counter\n'
+        'f5_bigiq_test_total{result="hit"} 6\n')
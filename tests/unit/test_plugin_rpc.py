@@ -0,0 +1,94 @@
+import threading
+
+import mock
+from neutron_lib import constants as q_const
+from neutron_lib.db import model_base
+import sqlalchemy
+from sqlalchemy import orm
+
+from neutron_lbaas.db.loadbalancer import models
+
+import conftest
+from f5_lbaasv2_bigiq_driver import db_api
+from f5_lbaasv2_bigiq_driver import plugin_rpc
+from f5_lbaasv2_bigiq_driver import status_table
+
+ONLINE = 'ONLINE'
+
+
+def _callbacks():
+    driver = mock.Mock()
+    driver.status_table = status_table.StatusTable()
+    return plugin_rpc.LBaaSv2PluginCallbacksRPC(driver)
+
+
+def test_concurrent_status_reports_keep_pending_delete(tmp_path):
+    # A file DB, so that each thread has its own connection
+    engine = sqlalchemy.create_engine(
+        'sqlite:///%s' % tmp_path.joinpath('test.db'),
+        connect_args={'timeout': 60, 'check_same_thread': False})
+    model_base.BASEV2.metadata.create_all(engine)
+    make_session = orm.sessionmaker(bind=engine, autocommit=True)
+
+    def new_context():
+        return mock.Mock(session=make_session())
+
+    factory = conftest.Factory(new_context())
+    factory.add_loadbalancer(members=200, status=q_const.PENDING_CREATE)
+    member_ids = [row.id for row in
+                  new_context().session.query(models.MemberV2.id)]
+    deleted_ids = member_ids[::2]
+    callbacks = _callbacks()
+    errors = []
+
+    def report(ids):
+        try:
+            for member_id in ids:
+                callbacks.update_member_status(
+                    new_context(), member_id=member_id,
+                    provisioning_status=q_const.ACTIVE,
+                    operating_status=ONLINE)
+        except Exception as e:
+            errors.append(e)
+
+    def delete():
+        try:
+            for member_id in deleted_ids:
+                context = new_context()
+                with context.session.begin():
+                    db_api.update_statuses(
+                        context.session, 'member', [member_id],
+                        provisioning_status=q_const.PENDING_DELETE)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=report, args=(member_ids[i::4],))
+               for i in range(4)]
+    threads.append(threading.Thread(target=delete))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    statuses = dict(new_context().session.query(
+        models.MemberV2.id, models.MemberV2.provisioning_status))
+    assert set(statuses[member_id] for member_id in deleted_ids) == set(
+        [q_const.PENDING_DELETE])
+    assert set(statuses[member_id] for member_id in member_ids
+               if member_id not in deleted_ids) == set([q_const.ACTIVE])
+    engine.dispose()
+
+
+def test_status_report_of_pending_delete_loadbalancer_sets_operating_status(
+        context, factory):
+    lb_id = factory.add_loadbalancer(status=q_const.PENDING_DELETE)
+
+    assert _callbacks().update_loadbalancer_status(
+        context, loadbalancer_id=lb_id, status=q_const.ACTIVE,
+        operating_status='OFFLINE')
+
+    context.session.expunge_all()
+    loadbalancer = context.session.query(models.LoadBalancer).one()
+    assert loadbalancer.provisioning_status == q_const.PENDING_DELETE
+    assert loadbalancer.operating_status == 'OFFLINE'
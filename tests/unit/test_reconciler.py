@@ -0,0 +1,114 @@
+import mock
+from neutron_lib import constants as q_const
+from oslo_config import cfg
+import pytest
+
+from f5_lbaasv2_bigiq_driver import constants
+from f5_lbaasv2_bigiq_driver import reconciler
+from f5_lbaasv2_bigiq_driver import service_builder
+
+
+@pytest.fixture
+def options():
+    yield cfg.CONF
+    cfg.CONF.clear_override('f5_bigiq_reconcile_threshold')
+    cfg.CONF.clear_override('f5_bigiq_reconcile_max_attempts')
+    cfg.CONF.clear_override('f5_bigiq_reconcile_batch_size')
+    cfg.CONF.clear_override('f5_bigiq_reconcile_rate')
+
+
+def _reconciler(version=constants.RPC_API_VERSION_TRACING):
+    driver = mock.Mock()
+    driver.service_builder = service_builder.LBaaSv2ServiceBuilder(driver)
+    driver.agent_rpc.supports.side_effect = (
+        lambda agent, required: version >= required)
+    return reconciler.Reconciler(driver)
+
+
+@mock.patch('f5_lbaasv2_bigiq_driver.reconciler.time')
+def test_find_stuck_after_threshold(clock, context, factory, options):
+    options.set_override('f5_bigiq_reconcile_threshold', 600)
+    lb_id = factory.add_loadbalancer(status=q_const.PENDING_CREATE,
+                                     listeners=0, pools=0)
+    stuck_reconciler = _reconciler()
+
+    clock.time.return_value = 1000
+    assert stuck_reconciler.find_stuck(context) == ({}, 1, 0)
+    clock.time.return_value = 1599
+    assert stuck_reconciler.find_stuck(context) == ({}, 1, 0)
+    clock.time.return_value = 1600
+    stuck, pending, abandoned = stuck_reconciler.find_stuck(context)
+
+    assert stuck == {lb_id: {('loadbalancer', lb_id): 'PENDING_CREATE'}}
+
+
+@mock.patch('f5_lbaasv2_bigiq_driver.reconciler.time')
+def test_find_stuck_gives_up_after_max_attempts(clock, context, factory,
+                                                options):
+    options.set_override('f5_bigiq_reconcile_threshold', 10)
+    options.set_override('f5_bigiq_reconcile_max_attempts', 2)
+    factory.add_loadbalancer(agent=factory.add_agent(), listeners=0,
+                             pools=0, status=q_const.PENDING_CREATE)
+    stuck_reconciler = _reconciler()
+    clock.time.return_value = 0
+    stuck_reconciler.find_stuck(context)
+
+    resent = []
+    for _ in range(4):
+        clock.time.return_value += 10
+        resent.append(stuck_reconciler.reconcile(context))
+
+    assert resent == [1, 1, 0, 0]
+    assert stuck_reconciler.stats()['abandoned'] == 1
+    assert stuck_reconciler.driver.agent_rpc.sync_services.call_count == 2
+
+
+def test_find_stuck_skips_loadbalancer_waiting_for_children(
+        context, factory, options):
+    options.set_override('f5_bigiq_reconcile_threshold', 0)
+    lb_id = factory.add_loadbalancer(status=q_const.PENDING_UPDATE,
+                                     listeners=0)
+
+    stuck, pending, abandoned = _reconciler().find_stuck(context)
+
+    assert pending == 3
+    assert sorted(key[0] for key in stuck[lb_id]) == ['member', 'pool']
+
+
+def test_updates_are_only_sent_in_services(context, factory, options):
+    options.set_override('f5_bigiq_reconcile_threshold', 0)
+    agent = factory.add_agent(version=constants.RPC_API_VERSION_DELTA_UPDATE)
+    factory.add_loadbalancer(agent=agent, status=q_const.PENDING_UPDATE,
+                             listeners=0)
+    stuck_reconciler = _reconciler(constants.RPC_API_VERSION_DELTA_UPDATE)
+
+    assert stuck_reconciler.reconcile(context) == 0
+
+    driver = stuck_reconciler.driver
+    assert not driver.agent_rpc.sync_services.called
+    assert not driver.pool.send_update.called
+    assert not driver.member.send_update.called
+    assert not driver.loadbalancer.send_update.called
+
+
+@mock.patch('f5_lbaasv2_bigiq_driver.reconciler.time')
+def test_reconcile_sends_rate_limited_batches(clock, context, factory,
+                                              options):
+    options.set_override('f5_bigiq_reconcile_threshold', 0)
+    options.set_override('f5_bigiq_reconcile_batch_size', 2)
+    options.set_override('f5_bigiq_reconcile_rate', 4.0)
+    agents = [factory.add_agent(host='agent-1'),
+              factory.add_agent(host='agent-2')]
+    for index in range(5):
+        factory.add_loadbalancer(agent=agents[index % 2], listeners=0,
+                                 pools=0, status=q_const.PENDING_CREATE)
+    stuck_reconciler = _reconciler()
+    clock.time.return_value = 0
+
+    assert stuck_reconciler.reconcile(context) == 5
+
+    calls = stuck_reconciler.driver.agent_rpc.sync_services.call_args_list
+    assert [(call[0][1], len(call[0][2])) for call in calls] == [
+        ('agent-1', 2), ('agent-1', 1), ('agent-2', 2)]
+    assert clock.sleep.call_args_list == [mock.call(0.25)] * 2
+    assert stuck_reconciler.stats()['batches_done'] == 3
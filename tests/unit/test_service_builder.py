@@ -0,0 +1,58 @@
+from f5_lbaasv2_bigiq_driver import service_builder
+
+
+def _build(context, query_counter, loadbalancer_ids):
+    context.session.expunge_all()
+    query_counter.count = 0
+    builder = service_builder.LBaaSv2ServiceBuilder(None)
+    services = builder.build_many(context, loadbalancer_ids)
+    return services, query_counter.count
+
+
+def _add_loadbalancers(factory, count):
+    # from_sqlalchemy_model walks the graph once per path to an entity:
+    # keep it small, with every relationship
+    return [factory.add_loadbalancer(listeners=1, pools=1, members=2,
+                                     l7policies=1, l7rules=1,
+                                     healthmonitor=True)
+            for _ in range(count)]
+
+
+def test_build_many_queries_do_not_grow_with_loadbalancers(
+        context, factory, query_counter):
+    one = _add_loadbalancers(factory, 1)
+    many = _add_loadbalancers(factory, 10)
+
+    _, one_queries = _build(context, query_counter, one)
+    services, many_queries = _build(context, query_counter, many)
+
+    assert many_queries == one_queries
+    assert [service['loadbalancer']['id'] for service in services] == many
+    for service in services:
+        assert len(service['listeners']) == 1
+        assert len(service['pools']) == 1
+        assert len(service['members']) == 2
+        assert len(service['healthmonitors']) == 1
+        assert len(service['l7policies']) == 1
+        assert len(service['l7policy_rules']) == 1
+
+
+def test_build_many_query_count(context, factory, query_counter):
+    loadbalancer_ids = _add_loadbalancers(factory, 5)
+
+    _, queries = _build(context, query_counter, loadbalancer_ids)
+
+    # The loadbalancers with their joined relationships, then one query
+    # per relationship loaded with selectinload
+    assert queries == 12
+
+
+def test_build_many_skips_deleted_loadbalancers(
+        context, factory, query_counter):
+    loadbalancer_id = factory.add_loadbalancer()
+
+    services, _ = _build(context, query_counter,
+                         ['missing', loadbalancer_id])
+
+    assert [service['loadbalancer']['id'] for service in services] == [
+        loadbalancer_id]
@@ -0,0 +1,52 @@
+from neutron_lib import constants as q_const
+
+from f5_lbaasv2_bigiq_driver import status_table
+
+ONLINE = 'ONLINE'
+
+
+def _recorded(table, *status):
+    assert table.accept('member', 'member-1', *status)
+    table.record('member', 'member-1', *status)
+
+
+def test_repeated_provisioning_status_is_written():
+    table = status_table.StatusTable()
+    _recorded(table, q_const.ACTIVE, ONLINE)
+
+    # The API may have changed the status in the DB since
+    assert table.accept('member', 'member-1', q_const.ACTIVE, ONLINE)
+
+
+def test_repeated_operating_status_is_dropped():
+    table = status_table.StatusTable()
+    _recorded(table, q_const.ACTIVE, ONLINE)
+
+    assert not table.accept('member', 'member-1', None, ONLINE)
+    assert table.accept('member', 'member-1', None, 'OFFLINE')
+    assert table.stats()['duplicates'] == 1
+
+
+def test_dedupe_window_drops_repeated_provisioning_status():
+    table = status_table.StatusTable()
+    table.dedupe_window = 60
+    _recorded(table, q_const.ACTIVE, ONLINE)
+
+    assert not table.accept('member', 'member-1', q_const.ACTIVE, ONLINE)
+    assert table.accept('member', 'member-1', q_const.ERROR, ONLINE)
+    table.invalidate('member', 'member-1')
+    assert table.accept('member', 'member-1', q_const.ACTIVE, ONLINE)
+
+
+def test_sequence_check_drops_late_reports():
+    table = status_table.StatusTable()
+    table.sequence_check = True
+    _recorded(table, q_const.ACTIVE, ONLINE, 2)
+
+    assert not table.accept('member', 'member-1', q_const.ERROR, ONLINE, 1)
+    # Invalidated by an API request, the order of the reports is kept
+    table.invalidate('member', 'member-1')
+    assert not table.accept('member', 'member-1', q_const.ERROR, ONLINE, 2)
+    assert table.accept('member', 'member-1', q_const.ERROR, ONLINE, 3)
+    # A restarted agent numbers its reports in a new epoch
+    assert table.accept('member', 'member-1', q_const.ERROR, ONLINE, 1, 1)